@@ -0,0 +1,180 @@
+"""
+Бенчмарк клиента против локального сервера redforester.server.
+Сервер запускается отдельным процессом, поэтому работа сервера не мешает измерениям клиента.
+Для каждого сценария выводятся пропускная способность, p50/p99 задержки одной операции
+и пиковая память клиента (отдельным прогоном под tracemalloc).
+
+    python benchmarks/bench_client.py --nodes 10000 --latency 0.002 --error-rate 0
+    python benchmarks/bench_client.py --scenarios single_get,tree_load --json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import redforester  # noqa: E402
+from redforester.server import LocalConfig  # noqa: E402
+
+
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+async def single_get(session, args, node_ids):
+    """Последовательные Nodes.async_get_by_id, операция - один запрос"""
+    nodes = redforester.Nodes(session)
+    latencies = []
+    for node_id in node_ids[:args.requests]:
+        started = time.perf_counter()
+        await nodes.async_get_by_id(node_id)
+        latencies.append(time.perf_counter() - started)
+    return len(latencies), latencies
+
+
+async def bulk_get(session, args, node_ids):
+    """Nodes.async_get_many, операция - пачка из --batch узлов"""
+    nodes = redforester.Nodes(session)
+    latencies = []
+    items = 0
+    for start in range(0, args.requests * 10, args.batch):
+        chunk = node_ids[start:start + args.batch]
+        if not chunk:
+            break
+        started = time.perf_counter()
+        await nodes.async_get_many(chunk, args.concurrency)
+        latencies.append(time.perf_counter() - started)
+        items += len(chunk)
+    return items, latencies
+
+
+async def batch_update(session, args, node_ids):
+    """Nodes.async_update по --batch изменённых узлов через /api/batch"""
+    repository = redforester.Nodes(session)
+    loaded = [node for node in await repository.async_get_many(node_ids[:args.batch * 5], args.concurrency)
+              if isinstance(node, redforester.Node)]
+    latencies = []
+    items = 0
+    for round_index in range(5):
+        chunk = loaded[round_index * args.batch:(round_index + 1) * args.batch]
+        for node in chunk:
+            node.hidden = not node.hidden
+        started = time.perf_counter()
+        await repository.async_update(*chunk)
+        latencies.append(time.perf_counter() - started)
+        items += len(chunk)
+    return items, latencies
+
+
+async def tree_load(session, args, node_ids):
+    """Maps.async_iter_nodes по всей карте, операция - загрузка карты целиком"""
+    maps = redforester.Maps(session)
+    latencies = []
+    items = 0
+    for _ in range(3):
+        started = time.perf_counter()
+        async for _ in maps.async_iter_nodes("map-0", chunk_depth=args.chunk_depth):
+            items += 1
+        latencies.append(time.perf_counter() - started)
+    return items, latencies
+
+
+SCENARIOS = {
+    "single_get": single_get,
+    "bulk_get": bulk_get,
+    "batch_update": batch_update,
+    "tree_load": tree_load,
+}
+
+
+async def run_scenario(name, args, config, node_ids, trace_memory=False):
+    async with redforester.Session("bench", "bench", config=config, logs=False) as session:
+        await redforester.Users(session).async_get()
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        items, latencies = await SCENARIOS[name](session, args, node_ids)
+        elapsed = time.perf_counter() - started
+        peak = 0
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return {
+        "scenario": name,
+        "items": items,
+        "seconds": elapsed,
+        "throughput": items / elapsed if elapsed else 0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def wait_for_port(host: str, port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Local server did not start on {host}:{port}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RedForester client benchmark")
+    parser.add_argument("--nodes", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--chunk-depth", type=int, default=None)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--json", default=None, help="записать результаты в файл")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-m", "redforester.server", "--port", str(port),
+                               "--nodes", str(args.nodes), "--latency", str(args.latency),
+                               "--error-rate", str(args.error_rate), "--seed", "1"], cwd=ROOT)
+    try:
+        wait_for_port("127.0.0.1", port)
+        config = LocalConfig("127.0.0.1", port)
+        node_ids = [f"map-0-node-{index}" for index in range(args.nodes)]
+        results = []
+        print(f"{'scenario':<14}{'items':>8}{'items/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>10}")
+        for name in args.scenarios.split(","):
+            result = asyncio.run(run_scenario(name, args, config, node_ids))
+            result["peak_memory_kb"] = asyncio.run(run_scenario(name, args, config, node_ids,
+                                                                trace_memory=True))["peak_memory_kb"]
+            results.append(result)
+            print(f"{name:<14}{result['items']:>8}{result['throughput']:>12,.0f}{result['p50_ms']:>10.2f}"
+                  f"{result['p99_ms']:>10.2f}{result['peak_memory_kb']:>10.0f}")
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump(results, file, indent=2)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
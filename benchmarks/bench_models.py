@@ -0,0 +1,97 @@
+"""
+Бенчмарк моделей: память на один Node и скорость создания узлов из ответа сервера.
+Для сравнения рядом измеряется прежняя реализация Node на dataclass.
+
+    python benchmarks/bench_models.py [количество узлов]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+sys.path.insert(0, __file__.rsplit("/", 2)[0])
+
+from redforester import Node  # noqa: E402
+
+
+@dataclass
+class LegacyDataNode:
+    changes: dict = field(default_factory=dict)
+
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        if not ("changes" in self.__dict__):
+            return
+        if key == "changes":
+            return
+        if key == "id":
+            key = "user_id"
+        self.changes[key] = value
+
+
+@dataclass
+class LegacyNode(LegacyDataNode):
+    id: str = ""
+    map_id: str = ""
+    parent: str = ""
+    position: list = field(default_factory=list)
+    properties: dict = field(default_factory=dict)
+    access: str = ""
+    originalParent: str = ""
+    body: str = ''
+    hidden: bool = False
+    readers: list = field(default_factory=list)
+    nodelevel: int = 1
+    meta: dict = field(default_factory=dict)
+    _properties_changes_: dict = field(default_factory=dict)
+
+
+def legacy_from_data(data: dict) -> LegacyNode:
+    node = LegacyNode(**data)
+    node.changes.clear()
+    return node
+
+
+def from_data(data: dict) -> Node:
+    return Node(**data)
+
+
+def make_data(count: int) -> list:
+    return [{
+        "id": f"node-{index}",
+        "map_id": "map",
+        "parent": f"node-{index // 10}",
+        "position": ["R", index % 10],
+        "access": "user_all",
+        "originalParent": f"node-{index // 10}",
+        "body": {"properties": {"global": {"title": f"title {index}"}}},
+        "hidden": False,
+        "nodelevel": 2,
+    } for index in range(count)]
+
+
+def measure(name: str, build, data: list):
+    gc.collect()
+    start = time.perf_counter()
+    nodes = [build(item) for item in data]
+    elapsed = time.perf_counter() - start
+    del nodes
+    gc.collect()
+    tracemalloc.start()
+    nodes = [build(item) for item in data]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del nodes
+    print(f"{name:<10} {len(data) / elapsed:>12,.0f} nodes/s {size / len(data):>10.0f} bytes/node")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    data = make_data(count)
+    measure("dataclass", legacy_from_data, data)
+    measure("slots", from_data, data)
+
+
+if __name__ == "__main__":
+    main()
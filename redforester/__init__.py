@@ -1,6 +1,14 @@
 import aiohttp
 import asyncio
 from .config import PRODUCTION_CONFIG, Config
+from .cache import Cache
+from .codec import JsonCodec, get_codec
+from .policy import RetryPolicy, TokenBucket, AdaptiveLimiter
+from .scheduler import Scheduler, INTERACTIVE, NORMAL, BULK
+from . import scheduler as _scheduler
+from .metrics import RequestMetrics, MetricsCollector
+from .snapshot import MapSnapshot, SnapshotDiff, SnapshotWriter, encode_node
+from . import metrics as _metrics
 import logging
 
 import json
@@ -8,17 +16,53 @@ import hashlib
 from dataclasses import dataclass, field
 import typing
 import datetime
+import collections
+import itertools
+import codecs
+import re
+import time
+import threading
 
 
 class Session:
     """
     Session - класс, необходимый для организации асинхронного общения с RedForester от имени пользователя
     Чтобы использовать на тестовом сервере, следует указать config = DEVELOPMENT_CONFIG
+    Session владеет одним пулом keep-alive соединений, через который проходят все запросы.
+    Пул создаётся лениво при первом запросе и закрывается методом close()/async_close()
+    или при выходе из контекстного менеджера (with / async with)
+    Если передан cache, ответы на GET-запросы кэшируются, а действия над ресурсом сбрасывают его кэш
+    retry задаёт правила повтора неудачных запросов (по умолчанию RetryPolicy()), rate_limit (TokenBucket)
+    ограничивает частоту запросов, limiter (AdaptiveLimiter) - число одновременных запросов
+    hooks - функции, получающие RequestMetrics после каждой HTTP-попытки (например, MetricsCollector).
+    logs=None оставляет настройку logging приложению
+    codec - кодек JSON (JsonCodec или имя: "json", "orjson", "ujson"), по умолчанию самый быстрый из установленных
+    single_flight - одновременные одинаковые GET-запросы выполняются одним HTTP-запросом,
+    ответ разбирается для каждого ожидающего отдельно
+    scheduler (Scheduler) распределяет запросы по классам приоритета interactive/normal/bulk,
+    чтобы массовые операции не задерживали срочные запросы (см. priority)
+    Синхронные методы (send, get, update...) выполняются через run(). При sync=True цикл событий сессии
+    работает в отдельном фоновом потоке: синхронные вызовы из любых потоков выполняются на нём параллельно
+    и делят общий пул соединений, в том числе если вызывающий поток сам выполняет цикл событий
     """
 
     def __init__(self, username: str, password: str, use_md5: bool = False, config: Config = PRODUCTION_CONFIG,
-                 logs=True, sync=False):
+                 logs=True, sync=False, limit: int = 100, limit_per_host: int = 30,
+                 keepalive_timeout: float = 30, timeout: float = 60, connect_timeout: float = 10,
+                 cache: Cache = None, retry: RetryPolicy = None, rate_limit: TokenBucket = None,
+                 limiter: AdaptiveLimiter = None, hooks: typing.Iterable[typing.Callable] = (),
+                 codec: typing.Union[str, JsonCodec] = None, single_flight: bool = True,
+                 scheduler: Scheduler = None):
         self.config = config
+        self.scheduler = scheduler
+        self.codec = get_codec(codec)
+        self.single_flight = single_flight
+        self._in_flight = {}
+        self.hooks = list(hooks)
+        self.cache = cache
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.rate_limit = rate_limit
+        self.limiter = limiter
         self.sync = sync
         if not use_md5:
             md5 = hashlib.md5()
@@ -26,40 +70,474 @@ class Session:
             password = md5.hexdigest()
         self.auth = aiohttp.BasicAuth(login=username, password=password, encoding="utf-8")
         self.loop = asyncio.new_event_loop()
-        if logs:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self._client = None
+        self._client_loop = None
+        # клиенты, брошенные при смене цикла событий, закрываются в close() на своих циклах
+        self._abandoned = []
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        if logs is None:
+            pass
+        elif logs:
             logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s: %(message)s',
                                 datefmt='%m.%d.%Y-%H:%M:%S')
         else:
             logging.basicConfig(level=logging.ERROR, format='[%(asctime)s] %(levelname)s:%(message)s',
                                 datefmt='%m.%d.%Y-%H:%M:%S')
 
+    def url(self, path: str) -> str:
+        return f"{self.config.PROTOCOL}://{self.config.BASIC_URL}{path}"
+
+    def add_hook(self, hook: typing.Callable):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: typing.Callable):
+        self.hooks.remove(hook)
+
+    async def get_client(self) -> aiohttp.ClientSession:
+        """
+        Возвращает общий aiohttp.ClientSession, создавая его при необходимости.
+        Клиент привязан к циклу событий, поэтому при смене цикла пул пересоздаётся, а старый закрывается
+        """
+        loop = asyncio.get_event_loop()
+        if self._client is not None and not self._client.closed and self._client_loop is loop:
+            return self._client
+        if self._client is not None and not self._client.closed:
+            logging.warning('Session.get_client, event loop changed, connection pool is recreated')
+            self._abandon_client()
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout)
+        self._client = aiohttp.ClientSession(auth=self.auth, connector=connector, timeout=self.timeout,
+                                             trace_configs=[_metrics.trace_config()])
+        self._client_loop = loop
+        return self._client
+
+    @staticmethod
+    def priority(name: str):
+        """
+        Контекстный менеджер: запросы внутри блока with (и запущенных в нём задач) получают приоритет name
+        """
+        return _scheduler.priority(name)
+
+    async def async_close(self):
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+        self._client = None
+        self._client_loop = None
+
+    def _abandon_client(self):
+        """
+        Отвязывает клиент от сессии и закрывает его на его цикле событий: сразу, если цикл работает в другом потоке,
+        иначе - в close(). Соединения клиента, чей цикл уже закрыт (например, после asyncio.run), закрыть нельзя:
+        такую сессию нужно было закрыть внутри цикла (await session.async_close() или async with)
+        """
+        client, loop = self._client, self._client_loop
+        self._client = None
+        self._client_loop = None
+        if client is None or client.closed:
+            return
+        if loop.is_closed():
+            raise RuntimeError("Session connection pool was left open in an event loop that is already closed, "
+                               "its connections leaked. Close the session in the loop that used it: "
+                               "await session.async_close() or async with Session(...)")
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.close(), loop)
+        else:
+            self._abandoned.append((client, loop))
+
+    def _start_thread(self):
+        with self._thread_lock:
+            if self._thread is None:
+                started = threading.Event()
+
+                def run_loop():
+                    asyncio.set_event_loop(self.loop)
+                    self.loop.call_soon(started.set)
+                    self.loop.run_forever()
+
+                self._thread = threading.Thread(target=run_loop, name="redforester-session", daemon=True)
+                self._thread.start()
+                started.wait()
+
+    def run(self, coroutine: typing.Awaitable):
+        """
+        Выполняет корутину на цикле событий сессии и возвращает результат
+        """
+        if not self.sync:
+            return self.loop.run_until_complete(coroutine)
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError("Session.run can not be called from the session loop thread, await the coroutine")
+        self._start_thread()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        if self.sync:
+            if self._thread is not None:
+                self.run(self.async_close())
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join()
+                self._thread = None
+            return
+        if self._client is not None and self._client_loop is not self.loop:
+            self._abandon_client()
+        abandoned, self._abandoned = self._abandoned, []
+        for client, loop in abandoned:
+            if not client.closed and not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(client.close())
+        if not self.loop.is_closed():
+            self.loop.run_until_complete(self.async_close())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.async_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _decode_body(codec: JsonCodec, status: int, raw: bytes):
+    """
+    Разбирает JSON ответа. Ответ с ошибкой может прийти не в JSON (страница прокси, текст) - тогда отдаётся текстом
+    """
+    try:
+        return codec.loads(raw)
+    except ValueError:
+        if status == 200:
+            raise
+        return raw.decode(errors="replace")
+
+
+def _action_targets(method: str, url: str, data) -> typing.List[typing.Tuple[str, bool]]:
+    """
+    POST добавляет ресурс в коллекцию url и меняет его родителя (data["parent"]),
+    остальные методы меняют сам ресурс url
+    """
+    if method != "POST":
+        return [(url, False)]
+    targets = [(url, True)]
+    if isinstance(data, dict) and data.get("parent"):
+        targets.append((f"{url.rstrip('/')}/{data['parent']}", False))
+    return targets
+
 
 class Request:
     """
-    Request - класс для совершения запросов получения данных от сервера RedForester. Использует информацию о сессии
+    Request - класс для совершения запросов получения данных от сервера RedForester. Использует информацию о сессии.
+    retry - правила повтора этого запроса вместо session.retry
     """
 
-    def __init__(self, session: Session, method: str, url: str, data: dict = {}):
+    def __init__(self, session: Session, method: str, url: str, data: dict = {}, timeout: float = None,
+                 cached: bool = True, headers: dict = None, priority: str = None, retry: RetryPolicy = None):
         self.session = session
+        self.priority = priority
+        self.retry = retry
         self.method = method
         self.url = url
         self.data = data
+        self.timeout = timeout
+        self.cached = cached
+        self.headers = headers
+        self.response_headers = None
+
+    def _request_kwargs(self) -> dict:
+        if self.timeout is None:
+            return {}
+        return {"timeout": aiohttp.ClientTimeout(total=self.timeout)}
+
+    async def _perform(self, headers: dict, data: bytes = None) \
+            -> typing.Tuple[int, bytes, typing.Mapping, typing.Optional[RequestMetrics]]:
+        """
+        Выполняет HTTP-запрос с учётом ограничений сессии и повторяет его по правилам retry (или session.retry).
+        Возвращает код ответа, тело ответа (bytes, читается один раз), заголовки
+        и замеры последней попытки (None, если у сессии нет hooks).
+        Замеры неудачных попыток передаются в hooks сразу, последней - после разбора ответа (см. _finish)
+        """
+        session = self.session
+        retry = self.retry if self.retry is not None else session.retry
+        attempt = 0
+        while True:
+            attempt += 1
+            metrics = None
+            if session.hooks:
+                metrics = RequestMetrics(self.__class__.__name__, self.method, self.url, attempt,
+                                         request_bytes=len(data) if data else 0)
+            priority = await self._acquire()
+            started = time.monotonic()
+            if metrics is not None:
+                metrics.queue_wait = time.perf_counter() - metrics.started
+            success = False
+            try:
+                client = await session.get_client()
+                async with client.request(self.method, session.url(self.url), headers=headers, data=data,
+                                          trace_request_ctx=metrics, **self._request_kwargs()) as response:
+                    status = response.status
+                    if metrics is not None:
+                        headers_received = time.perf_counter()
+                        metrics.ttfb = headers_received - metrics.started - metrics.queue_wait - metrics.connect
+                    raw = await response.read()
+                    response_headers = response.headers
+                    if metrics is not None:
+                        metrics.body = time.perf_counter() - headers_received
+                        metrics.response_bytes = len(raw)
+                        metrics.status = status
+                success = status < 500 and status != 429
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if metrics is not None:
+                    metrics.error = repr(e)
+                    metrics.total = time.perf_counter() - metrics.started
+                    _metrics.emit(session.hooks, metrics)
+                if not retry.should_retry(self.method, attempt):
+                    raise
+                delay = retry.delay(attempt)
+                logging.warning(f"{self.__class__.__name__}.async_send {self.method} {self.url}, error: {e!r}, "
+                                f"retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                await self._release(priority, success, time.monotonic() - started)
+            if not retry.should_retry(self.method, attempt, status):
+                return status, raw, response_headers, metrics
+            self._finish(metrics)
+            delay = retry.delay(attempt, response_headers.get("Retry-After"))
+            logging.warning(f"{self.__class__.__name__}.async_send {self.method} {self.url}, status: {status}, "
+                            f"retry in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def _acquire(self) -> typing.Optional[str]:
+        """
+        Ждёт очереди сессии: планировщика, ограничения частоты и числа одновременных запросов.
+        Возвращает класс приоритета, занятый в планировщике
+        """
+        session = self.session
+        priority = None
+        if session.scheduler is not None:
+            priority = await session.scheduler.acquire(self.priority)
+        try:
+            if session.rate_limit is not None:
+                await session.rate_limit.acquire()
+            if session.limiter is not None:
+                await session.limiter.acquire()
+        except BaseException:
+            if priority is not None:
+                session.scheduler.release(priority)
+            raise
+        return priority
+
+    async def _release(self, priority: typing.Optional[str], success: bool, latency: float):
+        session = self.session
+        if priority is not None:
+            session.scheduler.release(priority)
+        if session.limiter is not None:
+            await session.limiter.release(success, latency)
+
+    def _finish(self, metrics: typing.Optional[RequestMetrics], decode_started: float = None):
+        if metrics is None:
+            return
+        now = time.perf_counter()
+        if decode_started is not None:
+            metrics.decode = now - decode_started
+        metrics.total = now - metrics.started
+        _metrics.emit(self.session.hooks, metrics)
+
+    async def _fetch(self, cache: typing.Optional[Cache]) \
+            -> typing.Tuple[int, typing.Optional[bytes], typing.Mapping, typing.Optional[RequestMetrics]]:
+        """
+        Получает тело ответа с учётом кэша: свежая запись кэша или 304 Not Modified отдаются как 200
+        """
+        entry = None
+        headers = dict(self.headers) if self.headers else {}
+        if cache is not None:
+            entry, fresh = cache.lookup(self.url)
+            if fresh:
+                return 200, entry.body, {}, None
+            if entry is not None:
+                headers["If-None-Match"] = entry.etag
+        if cache is None:
+            return await self._perform(headers)
+        version = cache.begin(self.url)
+        try:
+            status, raw, response_headers, metrics = await self._perform(headers)
+            if status == 304:
+                if entry is None:
+                    return 304, None, response_headers, metrics
+                cache.revalidate(self.url)
+                return 200, entry.body, response_headers, metrics
+            if status == 200:
+                cache.put(self.url, raw, response_headers.get("ETag"), version)
+            return status, raw, response_headers, metrics
+        finally:
+            cache.end(self.url)
+
+    async def _fetch_shared(self, cache: typing.Optional[Cache]):
+        """
+        Single flight: пока GET-запрос по url выполняется, такие же запросы (с теми же cached, timeout и retry)
+        ждут его ответа, а не идут в сеть. Возвращает ответ и признак того, что запрос выполнял именно этот вызов
+        """
+        in_flight = self.session._in_flight
+        # cached=False не должен получить ответ из кэша, полученный запросом с cached=True, и наоборот
+        key = (asyncio.get_event_loop(), self.url, self.cached, self.timeout, self.retry)
+        task = in_flight.get(key)
+        owner = task is None
+        if owner:
+            task = asyncio.ensure_future(self._fetch(cache))
+            in_flight[key] = task
+
+            def done(finished):
+                if in_flight.get(key) is finished:
+                    del in_flight[key]
+                if not finished.cancelled():
+                    finished.exception()
+
+            task.add_done_callback(done)
+        # shield: отмена одного из ожидающих не отменяет запрос для остальных
+        return await asyncio.shield(task), owner
 
     async def async_send(self):
-        async with aiohttp.ClientSession(auth=self.session.auth) as session:
-            async with session.request(self.method,
-                                       f"{self.session.config.PROTOCOL}://{self.session.config.BASIC_URL}{self.url}",
-                                       ) as response:
-                if response.status in [500, 404]:
-                    logging.critical(f'Request.async_send {await response.text()}')
-                    return response.status, await response.text()
-                elif response.status != 200:
-                    data = json.loads(await response.text())
-                    logging.error(f"Request.async_send, code: {data['code']}, message: {data['message']}")
-                return response.status, json.loads(await response.text())
+        cache = self.session.cache if self.method == "GET" and self.cached else None
+        if self.method == "GET" and self.session.single_flight and not self.headers:
+            (status, raw, response_headers, metrics), owner = await self._fetch_shared(cache)
+            if not owner:
+                metrics = None
+        else:
+            status, raw, response_headers, metrics = await self._fetch(cache)
+        self.response_headers = response_headers
+        decode_started = time.perf_counter()
+        if raw is None:
+            self._finish(metrics)
+            return status, None
+        if status in [500, 404]:
+            self._finish(metrics)
+            text = raw.decode(errors="replace")
+            logging.critical(f'Request.async_send {text}')
+            return status, text
+        data = _decode_body(self.session.codec, status, raw)
+        self._finish(metrics, decode_started)
+        if status != 200:
+            _log_response_error("Request.async_send", (status, data))
+        return status, data
 
     def send(self):
-        return self.session.loop.run_until_complete(self.async_send())
+        return self.session.run(self.async_send())
+
+    async def async_iter_items(self, chunk_size: int = 64 * 1024):
+        """
+        Потоково читает ответ с JSON-массивом и отдаёт его элементы по мере получения, не дожидаясь
+        конца ответа и не держа его в памяти целиком. Если перестать читать итератор (break),
+        соединение закрывается и остаток ответа не скачивается.
+        Повторы по retry (или session.retry) возможны только до начала чтения тела. Ответ с ошибкой
+        (после исчерпания повторов) - aiohttp.ClientResponseError, оборванный или некорректный
+        массив - ValueError
+        """
+        session = self.session
+        retry = self.retry if self.retry is not None else session.retry
+        attempt = 0
+        while True:
+            attempt += 1
+            metrics = RequestMetrics(self.__class__.__name__, self.method, self.url, attempt) \
+                if session.hooks else None
+            priority = await self._acquire()
+            started = time.monotonic()
+            if metrics is not None:
+                metrics.queue_wait = time.perf_counter() - metrics.started
+            try:
+                client = await session.get_client()
+                response = await client.request(self.method, session.url(self.url), headers=self.headers,
+                                                trace_request_ctx=metrics, **self._request_kwargs())
+            except BaseException as e:
+                await self._release(priority, False, time.monotonic() - started)
+                if not isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+                    raise
+                if metrics is not None:
+                    metrics.error = repr(e)
+                    self._finish(metrics)
+                if not retry.should_retry(self.method, attempt):
+                    raise
+                await asyncio.sleep(retry.delay(attempt))
+                continue
+            if metrics is not None:
+                headers_received = time.perf_counter()
+                metrics.ttfb = headers_received - metrics.started - metrics.queue_wait - metrics.connect
+                metrics.status = response.status
+            if not retry.should_retry(self.method, attempt, response.status):
+                break
+            response.release()
+            await self._release(priority, False, time.monotonic() - started)
+            self._finish(metrics)
+            await asyncio.sleep(retry.delay(attempt, response.headers.get("Retry-After")))
+
+        self.response_headers = response.headers
+        complete = False
+        try:
+            if response.status != 200:
+                text = await response.text(errors="replace")
+                complete = True
+                logging.error(f"Request.async_iter_items {self.url}, status: {response.status}, body: {text}")
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                  message=text, headers=response.headers)
+            decoder = json.JSONDecoder()
+            utf8 = codecs.getincrementaldecoder("utf-8")()
+            buffer = ""
+            position = 0
+            opened = False
+            finished = False
+            while not finished:
+                chunk = await response.content.read(chunk_size)
+                if metrics is not None:
+                    metrics.response_bytes += len(chunk)
+                buffer = buffer[position:] + utf8.decode(chunk, final=not chunk)
+                position = 0
+                while True:
+                    while position < len(buffer) and buffer[position] in " \t\r\n,":
+                        position += 1
+                    if position >= len(buffer):
+                        break
+                    if not opened:
+                        if buffer[position] != "[":
+                            raise ValueError(f"{self.url} response is not a JSON array")
+                        opened = True
+                        position += 1
+                        continue
+                    if buffer[position] == "]":
+                        finished = True
+                        break
+                    try:
+                        item, end = decoder.raw_decode(buffer, position)
+                    except json.JSONDecodeError:
+                        if not chunk:
+                            raise
+                        break
+                    if buffer[position] not in '{["' and (end >= len(buffer) or buffer[end] in ".eE"):
+                        # число в конце куска могло прийти не целиком: "12." и "1" - уже корректный JSON,
+                        # а дальше может прийти "5" или "e5"
+                        if chunk or end >= len(buffer):
+                            break
+                        raise json.JSONDecodeError("Unterminated number", buffer, end)
+                    position = end
+                    yield item
+                if not chunk:
+                    break
+            if not finished:
+                raise ValueError(f"{self.url} response ended before the JSON array was closed")
+            complete = True
+        finally:
+            if complete:
+                response.release()
+            else:
+                response.close()
+            await self._release(priority, complete, time.monotonic() - started)
+            if metrics is not None:
+                metrics.body = time.perf_counter() - headers_received
+                self._finish(metrics)
 
     async def __call__(self, *args, **kwargs):
         return await self.async_send()
@@ -68,6 +546,7 @@ class Request:
 class Action(Request):
     """
     Action - класс для совершения действий в RedForester.
+    Тело запроса кодируется один раз (encode), ответ разбирается один раз кодеком сессии
     """
 
     def prepare_for_batch(self):
@@ -77,75 +556,387 @@ class Action(Request):
 
         }
         if len(self.data) > 0:
-            result["body"] = json.dumps(self.data)
+            result["body"] = self.session.codec.dumps(self.data).decode()
         return result
 
+    body: bytes = None
+
+    def encode(self) -> bytes:
+        if self.body is not None:
+            return self.body
+        return self.session.codec.dumps(self.data)
+
+    def targets(self) -> typing.List[typing.Tuple[str, bool]]:
+        """
+        Ресурсы, которые меняет действие: пары (url, признак добавления в коллекцию)
+        """
+        if self.url == "/api/batch" and isinstance(self.data, list):
+            targets = []
+            for item in self.data:
+                body = item.get("body")
+                if isinstance(body, str):
+                    try:
+                        body = self.session.codec.loads(body)
+                    except ValueError:
+                        body = None
+                targets.extend(_action_targets(item.get("method", "POST"), item["url"], body))
+            return targets
+        return _action_targets(self.method, self.url, self.data)
+
+    def invalidate_cache(self, targets: typing.List[typing.Tuple[str, bool]] = None):
+        """
+        Сбрасывает записи кэша и выполняющиеся общие GET-запросы (single flight) по изменяемым ресурсам:
+        GET, отправленный после изменения, не должен получить ответ запроса, начатого до него
+        """
+        cache = self.session.cache
+        in_flight = self.session._in_flight
+        for url, collection in targets if targets is not None else self.targets():
+            if cache is not None:
+                cache.invalidate(url, collection)
+            if in_flight:
+                urls = Cache.affected(url, {key[1] for key in in_flight}, collection)
+                for key in [key for key in in_flight if key[1] in urls]:
+                    del in_flight[key]
+
     async def async_send(self):
         headers = {
             "Content-Type": "application/json"
         }
-        async with aiohttp.ClientSession(auth=self.session.auth) as session:
-            async with session.request(self.method,
-                                       f"{self.session.config.PROTOCOL}://{self.session.config.BASIC_URL}{self.url}",
-                                       data=json.dumps(self.data), headers=headers) as response:
-                if response.status in [500, 404]:
-                    logging.critical(f'Action.async_send {await response.text()}')
-                    return response.status, await response.text()
-                elif response.status != 200:
-                    data = json.loads(await response.text())
-                    logging.error(f"Action.async_send, code: {data['code']}, message: {data['message']}")
-                return response.status, await response.text()
+        targets = self.targets()
+        self.invalidate_cache(targets)
+        status, raw, _, metrics = await self._perform(headers, self.encode())
+        # повторный сброс - на случай GET, начатого во время выполнения действия: его ответ мог быть получен
+        # до изменения. GET, начатые раньше, не попадут в кэш сами (см. Cache.begin)
+        self.invalidate_cache(targets)
+        if status in [500, 404]:
+            self._finish(metrics)
+            text = raw.decode(errors="replace")
+            logging.critical(f'Action.async_send {text}')
+            return status, text
+        decode_started = time.perf_counter()
+        data = _decode_body(self.session.codec, status, raw) if raw else None
+        self._finish(metrics, decode_started)
+        if status != 200:
+            _log_response_error("Action.async_send", (status, data))
+        return status, data
 
     def send(self):
-        return self.session.loop.run_until_complete(self.async_send())
+        return self.session.run(self.async_send())
 
     async def __call__(self, *args, **kwargs):
         return await self.async_send()
 
 
+@dataclass
+class ActionResult:
+    """
+    ActionResult - результат выполнения одного Action в составе Sequence
+    """
+    action: Action
+    status: int
+    body: typing.Any = None
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+
 class Sequence(Action):
     """
     Sequence - позволяет совершить последовательно множество дейтсвий.
     Организует отдельные Action в batch-запрос, что ускоряет выполнение действий на стороне сервера.
+    async_send отправляет все действия одним запросом, async_execute разбивает их на части
+    не длиннее max_actions действий и max_bytes байт и возвращает результат каждого действия.
+    Если части независимы друг от друга, их можно отправлять параллельно (concurrency > 1)
     """
 
-    def __init__(self, session: Session, actions: tuple = ()):
-        super().__init__(session=session, method="POST", url="/api/batch")
+    def __init__(self, session: Session, actions: tuple = (), max_actions: int = 100,
+                 max_bytes: int = 512 * 1024, concurrency: int = 1, priority: str = None):
+        super().__init__(session=session, method="POST", url="/api/batch", priority=priority)
         self.actions = actions
         self.data = [action.prepare_for_batch() for action in self.actions]
+        self._encoded = None
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+
+    def _encoded_items(self) -> typing.List[bytes]:
+        if self._encoded is None or len(self._encoded) != len(self.data):
+            self._encoded = [self.session.codec.dumps(prepared) for prepared in self.data]
+        return self._encoded
+
+    def encode(self, chunk: typing.List[int] = None) -> bytes:
+        """
+        Собирает тело batch-запроса из заранее закодированных действий, без повторного кодирования
+        """
+        items = self._encoded_items()
+        if chunk is not None:
+            items = [items[index] for index in chunk]
+        return b"[" + b",".join(items) + b"]"
+
+    def chunks(self) -> typing.List[typing.List[int]]:
+        """
+        Разбивает действия на части, возвращает списки индексов действий
+        """
+        chunks = []
+        current = []
+        size = 2
+        for index, encoded in enumerate(self._encoded_items()):
+            item_size = len(encoded) + 1
+            if current and (len(current) >= self.max_actions or size + item_size > self.max_bytes):
+                chunks.append(current)
+                current = []
+                size = 2
+            current.append(index)
+            size += item_size
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _send_chunk(self, chunk: typing.List[int]) -> typing.List[ActionResult]:
+        batch = Action(self.session, "POST", self.url, [self.data[index] for index in chunk], priority=self.priority)
+        batch.body = self.encode(chunk)
+        status, items = await batch.async_send()
+        if status != 200:
+            return [ActionResult(self.actions[index], status, items) for index in chunk]
+        if not isinstance(items, list) or len(items) != len(chunk):
+            # ответ без разбивки по действиям - считаем, что все действия части выполнены
+            return [ActionResult(self.actions[index], status, items) for index in chunk]
+        results = []
+        for index, item in zip(chunk, items):
+            item_status = status
+            body = item
+            if isinstance(item, dict):
+                item_status = item.get("status", item.get("code", status))
+                body = item.get("body", item)
+                if isinstance(body, str) and body:
+                    try:
+                        body = self.session.codec.loads(body)
+                    except ValueError:
+                        pass
+            results.append(ActionResult(self.actions[index], int(item_status), body))
+        return results
+
+    async def async_execute(self) -> typing.List[ActionResult]:
+        """
+        Выполняет все действия по частям. Возвращает ActionResult для каждого действия в исходном порядке,
+        чтобы повторить можно было только неудавшиеся: [r.action for r in results if not r.ok].
+        Если часть не удалось отправить (ошибка соединения), её действия получают status 0 и исключение в body.
+        При последовательной отправке (concurrency=1) следующие части после такой ошибки не отправляются
+        и тоже получают status 0 (body=None)
+        """
+        chunks = self.chunks()
+        results = []
+        if self.concurrency <= 1:
+            for position, chunk in enumerate(chunks):
+                try:
+                    results.extend(await self._send_chunk(chunk))
+                except Exception as e:
+                    logging.error(f"Sequence.execute, error: {e!r}")
+                    results.extend(ActionResult(self.actions[index], 0, e) for index in chunk)
+                    results.extend(ActionResult(self.actions[index], 0) for unsent in chunks[position + 1:]
+                                   for index in unsent)
+                    break
+            return results
+        for chunk, chunk_results in zip(chunks, await _gather_limited(self.session, self._send_chunk, chunks,
+                                                                        self.concurrency)):
+            if isinstance(chunk_results, Exception):
+                chunk_results = [ActionResult(self.actions[index], 0, chunk_results) for index in chunk]
+            results.extend(chunk_results)
+        return results
+
+    def execute(self) -> typing.List[ActionResult]:
+        return self.session.run(self.async_execute())
+
+
+def _log_response_error(name: str, response: tuple):
+    body = response[1]
+    if isinstance(body, dict) and "code" in body and "message" in body:
+        logging.error(f"{name}, code: {body['code']}, message: {body['message']}")
+    else:
+        logging.error(f"{name}, " + str(response))
+
+
+def _log_failed_results(name: str, results: typing.List[ActionResult]):
+    for result in results:
+        if not result.ok:
+            body = result.body
+            if isinstance(body, dict) and "code" in body and "message" in body:
+                logging.error(f"{name}, {result.action.method} {result.action.url}, "
+                              f"code: {body['code']}, message: {body['message']}")
+            else:
+                logging.error(f"{name}, {result.action.method} {result.action.url}, "
+                              f"status: {result.status}, body: {body}")
+
+
+async def _iter_limited(session: Session, func, items, concurrency: int = None):
+    """
+    Выполняет func(item) для каждого элемента items, держа в работе не более concurrency вызовов.
+    Отдаёт пары (индекс, результат) по мере завершения. Исключение отдельного вызова не прерывает
+    обработку остальных - оно возвращается вместо результата
+    """
+    if concurrency is None:
+        concurrency = session.limit_per_host
+    concurrency = max(1, concurrency)
+
+    async def run(index, item):
+        try:
+            return index, await func(item)
+        except Exception as e:
+            logging.error(f"{func.__qualname__}, item: {item}, error: {e!r}")
+            return index, e
+
+    iterator = iter(enumerate(items))
+    pending = set()
+    try:
+        for index, item in iterator:
+            pending.add(asyncio.ensure_future(run(index, item)))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+            for index, item in iterator:
+                pending.add(asyncio.ensure_future(run(index, item)))
+                if len(pending) >= concurrency:
+                    break
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _gather_limited(session: Session, func, items, concurrency: int = None) -> list:
+    items = list(items)
+    results = [None] * len(items)
+    async for index, result in _iter_limited(session, func, items, concurrency):
+        results[index] = result
+    return results
+
+
+class LazyField:
+    """
+    LazyField - поле модели для редко используемых контейнеров (meta, readers, properties...).
+    Пока к полю не обращались, в слоте лежит None или исходная JSON-строка: значение по умолчанию
+    создаётся, а строка декодируется только при первом чтении
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = None
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.slot = owner.__dict__[f"_lazy_{name}"]
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = self.slot.__get__(obj, owner)
+        if value is None:
+            value = self.factory()
+            self.slot.__set__(obj, value)
+        elif isinstance(value, (str, bytes)) and value[:1] in ("{", "[", b"{", b"["):
+            value = json.loads(value)
+            self.slot.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        self.slot.__set__(obj, value)
 
 
-@dataclass
 class DataNode:
-    changes: dict = field(default_factory=dict)
+    """
+    DataNode - базовый класс моделей. Поля хранятся в __slots__, значения по умолчанию описываются в _defaults_
+    (None для LazyField). Присваивание поля после создания объекта записывается в changes,
+    сам словарь changes создаётся только при первом изменении
+    """
+    __slots__ = ("_changes", "_unit_of_work_")
+    _defaults_ = {}
+    # ссылки на UnitOfWork/MapTree, которые следят за объектом; не копируются и не сериализуются
+    _transient_ = ("_unit_of_work_",)
+
+    def __init__(self, changes: dict = None, **kwargs):
+        set_field = object.__setattr__
+        set_field(self, "_changes", changes or None)
+        for name in self._transient_:
+            set_field(self, name, None)
+        for name, default in self._defaults_.items():
+            set_field(self, name, kwargs.pop(name) if name in kwargs else default)
+        if kwargs:
+            raise TypeError(f"{self.__class__.__name__}.__init__() got an unexpected keyword argument "
+                            f"'{next(iter(kwargs))}'")
+
+    @property
+    def changes(self) -> dict:
+        if self._changes is None:
+            object.__setattr__(self, "_changes", {})
+        return self._changes
+
+    @changes.setter
+    def changes(self, value: dict):
+        object.__setattr__(self, "_changes", value)
+
+    def has_changes(self) -> bool:
+        return bool(self._changes)
 
     def __setattr__(self, key, value):
         super().__setattr__(key, value)
-        if not ("changes" in self.__dict__):
-            return
-        if key == "changes":
+        if key == "changes" or key.startswith("_"):
             return
         if key == "id":
             key = "user_id"
         self.changes[key] = value
+        self._mark_dirty_()
         # print('SET', key, value)
 
+    def _mark_dirty_(self):
+        unit = self._unit_of_work_
+        if unit is not None:
+            unit.mark_dirty(self)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self._defaults_)
+        return f"{self.__class__.__name__}(changes={self.changes!r}, {fields})"
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.changes == other.changes and all(getattr(self, name) == getattr(other, name)
+                                                     for name in self._defaults_)
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return {name: object.__getattribute__(self, name) for cls in self.__class__.__mro__
+                for name in cls.__dict__.get("__slots__", ()) if name not in self._transient_}
+
+    def __setstate__(self, state):
+        for name in self._transient_:
+            object.__setattr__(self, name, None)
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
 
-@dataclass
 class User(DataNode):
     """
     User - класс для хранения данных о пользователе
     """
-    current: bool = True
-    user_id: str = ""
-    username: str = ""
-    name: str = ""
-    surname: str = ""
-    avatar: str = ""
-    registration_date: str = ""
-    birthday: str = ""
-    kv_session: str = ""
-    is_extension_user: str = ""
+    __slots__ = ("current", "user_id", "username", "name", "surname", "avatar", "registration_date", "birthday",
+                 "kv_session", "is_extension_user")
+    _defaults_ = {
+        "current": True,
+        "user_id": "",
+        "username": "",
+        "name": "",
+        "surname": "",
+        "avatar": "",
+        "registration_date": "",
+        "birthday": "",
+        "kv_session": "",
+        "is_extension_user": "",
+    }
 
 
 class Users:
@@ -162,22 +953,24 @@ class Users:
         if not user.current:
             logging.error('Вы не можете изменять данные другого пользователя!')
             return
-        if len(user.changes.keys()) > 0:
-            action = Action(self.session, 'PATCH', '/api/user', user.changes)
+        for action in self._update_actions(user):
             response = await action.async_send()
             if response[0] != 200:
-                data = json.loads(response[1])
-                logging.error(f"Users.update, code: {data['code']}, message: {data['message']}")
+                _log_response_error("Users.update", response)
+
+    def _update_actions(self, user: User) -> typing.List[Action]:
+        if not user.current or len(user.changes.keys()) == 0:
+            return []
+        return [Action(self.session, 'PATCH', '/api/user', dict(user.changes))]
 
     def update(self, user: User):
-        self.session.loop.run_until_complete(self.async_update(user))
+        self.session.run(self.async_update(user))
 
     async def async_get(self):
         request = Request(self.session, "GET", "/api/user")
         response = await request.async_send()
         if response[0] != 200:
-            data = json.loads(response[1])
-            logging.error(f"Users.get, code: {data['code']}, message: {data['message']}")
+            _log_response_error("Users.get", response)
 
             return None
         else:
@@ -194,11 +987,10 @@ class Users:
                 "is_extension_user": response[1]["is_extension_user"],
             }
             user = User(**args)
-            user.changes.clear()
             return user
 
     def get(self):
-        return self.session.loop.run_until_complete(self.async_get())
+        return self.session.run(self.async_get())
 
         # print('SET', key, value)
 
@@ -206,8 +998,7 @@ class Users:
         request = Request(self.session, "GET", f"/api/user/{user_id}")
         response = await request.async_send()
         if response[0] != 200:
-            data = json.loads(response[1])
-            logging.error(f"Users.get_by_id, code: {data['code']}, message: {data['message']}")
+            _log_response_error("Users.get_by_id", response)
             return None
         else:
             args = {
@@ -223,33 +1014,45 @@ class Users:
                 "is_extension_user": response[1]["is_extension_user"],
             }
             user = User(**args)
-            user.changes.clear()
             return user
 
     def get_by_id(self, user_id: str):
-        return self.session.loop.run_until_complete(self.async_get_by_id(user_id))
+        return self.session.run(self.async_get_by_id(user_id))
+
+    async def async_get_many(self, user_ids: typing.Iterable[str], concurrency: int = None) -> list:
+        """
+        Загружает несколько объектов параллельно, не более concurrency запросов одновременно.
+        Результаты возвращаются в порядке user_ids: объект, None при ошибке сервера или исключение
+        """
+        return await _gather_limited(self.session, self.async_get_by_id, user_ids, concurrency)
+
+    def get_many(self, user_ids: typing.Iterable[str], concurrency: int = None) -> list:
+        return self.session.run(self.async_get_many(user_ids, concurrency))
+
+    async def async_iter_many(self, user_ids: typing.Iterable[str], concurrency: int = None):
+        """
+        То же, что async_get_many, но отдаёт пары (user_id, результат) по мере завершения запросов
+        """
+        user_ids = list(user_ids)
+        async for index, result in _iter_limited(self.session, self.async_get_by_id, user_ids, concurrency):
+            yield user_ids[index], result
 
 
-@dataclass
 class Map(DataNode):
-    id: str = ""
-    root_node_id: str = ""
-    owner: str = ""
-    owner_name: str = ""
-    owner_avatar: str = ""
-    layout: str = "LR"
-    public: bool = False
-    node_count: int = 0
-    user_count: int = 0
-    name: str = "noname"
-
-    def __init__(self, *args, **kwargs):
-        self.__dict__.update(kwargs)
-        # print(self.__dict__)
-        # for kwarg in kwargs:
-        #     print(kwargs)
-        super().__init__()
-        self.changes.clear()
+    __slots__ = ("id", "root_node_id", "owner", "owner_name", "owner_avatar", "layout", "public", "node_count",
+                 "user_count", "name")
+    _defaults_ = {
+        "id": "",
+        "root_node_id": "",
+        "owner": "",
+        "owner_name": "",
+        "owner_avatar": "",
+        "layout": "LR",
+        "public": False,
+        "node_count": 0,
+        "user_count": 0,
+        "name": "noname",
+    }
 
 
 class Maps:
@@ -267,39 +1070,32 @@ class Maps:
             action = Action(self.session, 'POST', '/api/maps', map.changes)
             actions.append(action)
         sequence = Sequence(self.session, tuple(actions))
-
-        response = await sequence.async_send()
-        # print(response)
-        if response[0] != 200:
-            if response[0] != 404:
-                data = json.loads(response[1])
-                logging.error(f"Maps.update, code: {data['code']}, message: {data['message']}")
-            else:
-                logging.error(f"Maps.update, " + str(response))
+        results = await sequence.async_execute()
+        _log_failed_results("Maps.create", results)
+        return results
 
     def create(self, *maps: typing.List[Map]):
-        self.session.loop.run_until_complete(self.async_create(*maps))
+        return self.session.run(self.async_create(*maps))
 
     async def async_update(self, *maps: typing.List[Map]):
         actions = []
         for map in maps:
-            if len(map.changes.keys()) > 0:
-                action = Action(self.session, 'PATCH', f'/api/maps/{map.id}', map.changes)
-                actions.append(action)
+            actions.extend(self._update_actions(map))
 
         if len(actions) > 0:
             sequence = Sequence(self.session, tuple(actions))
-            response = await sequence.async_send()
-            # print(response)
-            if response[0] != 200:
-                if response[0] != 404:
-                    data = json.loads(response[1])
-                    logging.error(f"Maps.update, code: {data['code']}, message: {data['message']}")
-                else:
-                    logging.error(f"Maps.update, " + str(response))
+            results = await sequence.async_execute()
+            _log_failed_results("Maps.update", results)
+            return results
+        return []
+
+    def _update_actions(self, map: Map) -> typing.List[Action]:
+        if len(map.changes.keys()) == 0:
+            return []
+        return [Action(self.session, 'PATCH', f'/api/maps/{map.id}', dict(map.changes))]
 
     def update(self, *maps: typing.List[Map]):
-        self.session.loop.run_until_complete(self.async_update(*maps))
+        return self.session.run(self.async_update(*maps))
 
     async def async_get_all(self):
         request = Request(self.session, "GET", f"/api/maps")
@@ -324,12 +1120,11 @@ class Maps:
 
                 }
                 map = Map(**args)
-                map.changes.clear()
                 maps.append(map)
             return maps
 
     def get_all(self):
-        return self.session.loop.run_until_complete(self.async_get_all())
+        return self.session.run(self.async_get_all())
 
     async def async_get_by_id(self, map_id: str):
         request = Request(self.session, "GET", f"/api/maps/{map_id}")
@@ -353,28 +1148,210 @@ class Maps:
 
             }
             map = Map(**args)
-            map.changes.clear()
             return map
 
     def get_by_id(self, map_id: str):
-        return self.session.loop.run_until_complete(self.async_get_by_id(map_id))
+        return self.session.run(self.async_get_by_id(map_id))
+
+    async def async_get_many(self, map_ids: typing.Iterable[str], concurrency: int = None) -> list:
+        """
+        Загружает несколько объектов параллельно, не более concurrency запросов одновременно.
+        Результаты возвращаются в порядке map_ids: объект, None при ошибке сервера или исключение
+        """
+        return await _gather_limited(self.session, self.async_get_by_id, map_ids, concurrency)
+
+    def get_many(self, map_ids: typing.Iterable[str], concurrency: int = None) -> list:
+        return self.session.run(self.async_get_many(map_ids, concurrency))
+
+    async def async_iter_many(self, map_ids: typing.Iterable[str], concurrency: int = None):
+        """
+        То же, что async_get_many, но отдаёт пары (map_id, результат) по мере завершения запросов
+        """
+        map_ids = list(map_ids)
+        async for index, result in _iter_limited(self.session, self.async_get_by_id, map_ids, concurrency):
+            yield map_ids[index], result
+
+    async def async_iter_all(self):
+        """
+        То же, что async_get_all, но отдаёт Map по мере чтения ответа (см. Request.async_iter_items).
+        Обработку можно начинать с первой карты и прервать в любой момент
+        """
+        request = Request(self.session, "GET", "/api/maps")
+        async for map_data in request.async_iter_items():
+            yield _map_from_data(map_data)
+
+    async def async_iter_nodes(self, map_id: str, order: str = "bfs", max_depth: int = None,
+                               chunk_depth: int = None):
+        """
+        Лениво обходит все узлы карты начиная с корня, см. Nodes.async_iter_tree
+        """
+        map = await self.async_get_by_id(map_id)
+        if map is None:
+            return
+        async for node in Nodes(self.session).async_iter_tree(map_id, map.root_node_id, order, max_depth,
+                                                              chunk_depth):
+            yield node
+
+    def get_nodes(self, map_id: str, order: str = "bfs", max_depth: int = None,
+                  chunk_depth: int = None) -> typing.List["Node"]:
+        async def collect():
+            return [node async for node in self.async_iter_nodes(map_id, order, max_depth, chunk_depth)]
+
+        return self.session.run(collect())
+
+    async def _async_get_tree(self, map: Map, etag: str = None) -> typing.Tuple[int, typing.Any, typing.Optional[str]]:
+        """
+        Загружает всё дерево карты одним запросом. С etag сервер может ответить 304, если дерево не менялось
+        """
+        request = Request(self.session, "GET", f"/api/maps/{map.id}/nodes/{map.root_node_id}", cached=False,
+                          headers={"If-None-Match": etag} if etag else None)
+        status, data = await request.async_send()
+        if status not in (200, 304):
+            logging.error('Maps.get_tree' + str((status, data)))
+        return status, data, request.response_headers.get("ETag")
+
+    async def async_export(self, map_id: str, path: str) -> typing.Optional[int]:
+        """
+        Сохраняет карту со всеми узлами в файл снимка (см. redforester.snapshot), возвращает число узлов.
+        Узлы пишутся в файл по мере обхода дерева, модели Node не создаются
+        """
+        map = await self.async_get_by_id(map_id)
+        if map is None:
+            return None
+        status, tree, etag = await self._async_get_tree(map)
+        if status != 200:
+            return None
+        with SnapshotWriter(path, _map_record(map), etag) as writer:
+            for data in _walk_tree(tree):
+                writer.add(data["id"], _node_record(data))
+        return writer.count
+
+    def export(self, map_id: str, path: str) -> typing.Optional[int]:
+        return self.session.run(self.async_export(map_id, path))
+
+    def open_snapshot(self, path: str) -> MapSnapshot:
+        """
+        Открывает снимок для чтения: узлы отдаются как Node, карта - как Map
+        """
+        return MapSnapshot(path, node_factory=_node_from_data, map_factory=Map)
+
+    async def async_sync(self, path: str, tree: "MapTree" = None) -> typing.Optional[SnapshotDiff]:
+        """
+        Обновляет снимок до текущего состояния карты и возвращает отличия.
+        Дерево запрашивается с If-None-Match по ETag снимка: если карта не менялась, узлы не скачиваются.
+        Иначе строки неизменённых узлов сравниваются побайтно без разбора JSON, файл заменяется атомарно.
+        Если передан tree (MapTree, загруженный из того же снимка), отличия применяются и к нему
+        """
+        snapshot = MapSnapshot(path)
+        try:
+            map = await self.async_get_by_id(snapshot.header["map"]["id"])
+            if map is None:
+                return None
+            map_record = _map_record(map)
+            status, data, etag = await self._async_get_tree(map, snapshot.etag)
+            diff = SnapshotDiff()
+            if status == 304:
+                diff.unchanged = len(snapshot)
+                if map_record == snapshot.header["map"]:
+                    return diff
+                etag = etag or snapshot.etag
+            elif status != 200:
+                return None
+            writer = SnapshotWriter(path, map_record, etag)
+            try:
+                if status == 304:
+                    for node_id in snapshot.ids():
+                        writer.add_line(snapshot.line(node_id))
+                else:
+                    seen = set()
+                    for node_data in _walk_tree(data):
+                        node_id = node_data["id"]
+                        line = encode_node(node_id, _node_record(node_data))
+                        old = snapshot.line(node_id)
+                        if old is None:
+                            diff.added.append(node_id)
+                        elif old != line:
+                            diff.updated.append(node_id)
+                        else:
+                            diff.unchanged += 1
+                        seen.add(node_id)
+                        writer.add_line(line)
+                    diff.removed = [node_id for node_id in snapshot.ids() if node_id not in seen]
+            except BaseException:
+                writer.abort()
+                raise
+        finally:
+            snapshot.close()
+        writer.close()
+        if tree is not None and diff:
+            with self.open_snapshot(path) as updated:
+                for node_id in diff.removed:
+                    tree.remove(node_id)
+                for node_id in diff.added + diff.updated:
+                    tree.add(updated.get(node_id))
+        return diff
+
+    def sync(self, path: str, tree: "MapTree" = None) -> typing.Optional[SnapshotDiff]:
+        return self.session.run(self.async_sync(path, tree))
+
+
+# значения полей, которых нет в ответе сервера (как в Maps.async_get_all)
+_MAP_FALLBACKS = dict(Map._defaults_, layout="", name="")
+
+
+def _map_from_data(data: dict) -> Map:
+    return Map(**{key: data.get(key, default) for key, default in _MAP_FALLBACKS.items()})
+
+
+def _map_record(map: Map) -> dict:
+    return {name: getattr(map, name) for name in Map._defaults_}
+
+
+def _node_record(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key in Node._defaults_ and not key.startswith("_")}
+
+
+def _walk_tree(data: dict) -> typing.Iterator[dict]:
+    """
+    Обходит дерево из ответа сервера в глубину, у отдаваемых узлов body["children"] удаляется
+    """
+    stack = [data]
+    while stack:
+        data = stack.pop()
+        body = data.get("body")
+        children = body.pop("children", None) if isinstance(body, dict) else None
+        if children:
+            stack.extend(reversed(children))
+        yield data
 
 
-@dataclass
 class Node(DataNode):
-    id: str = ""
-    map_id: str = ""
-    parent: str = ""
-    position: list = field(default_factory=list)
-    properties: dict = field(default_factory=dict)
-    access: str = ""
-    originalParent: str = ""
-    body: str = ''
-    hidden: bool = False
-    readers: list = field(default_factory=list)
-    nodelevel: int = 1
-    meta: dict = field(default_factory=dict)
-    _properties_changes_: dict = field(default_factory=dict)
+    __slots__ = ("id", "map_id", "parent", "_lazy_position", "_lazy_properties", "access", "originalParent", "body",
+                 "hidden", "_lazy_readers", "nodelevel", "_lazy_meta", "_lazy__properties_changes_", "_map_tree_")
+    _transient_ = ("_unit_of_work_", "_map_tree_")
+    _defaults_ = {
+        "id": "",
+        "map_id": "",
+        "parent": "",
+        "position": None,
+        "properties": None,
+        "access": "",
+        "originalParent": "",
+        "body": '',
+        "hidden": False,
+        "readers": None,
+        "nodelevel": 1,
+        "meta": None,
+        "_properties_changes_": None,
+    }
+    position = LazyField(list)
+    properties = LazyField(dict)
+    readers = LazyField(list)
+    meta = LazyField(dict)
+    _properties_changes_ = LazyField(dict)
+
+    def has_changes(self) -> bool:
+        return super().has_changes() or bool(self._lazy__properties_changes_)
 
     @staticmethod
     def create(map_id: str, parent: str, properties={"global": {"title": f"{datetime.datetime.now()}"}},
@@ -396,25 +1373,144 @@ class Node(DataNode):
         finally:
             return value
 
-    def property_set(self, group, key, value):
-        try:
-            self.body["properties"][group][key] = value
-        except KeyError:
-            pass
+    def _body_properties_(self) -> dict:
+        if not isinstance(self.body, dict):
+            object.__setattr__(self, "body", {})
+        properties = self.body.get("properties")
+        if not isinstance(properties, dict):
+            properties = self.body["properties"] = {}
+        return properties
+
+    def _record_property_change_(self, operation: str, group: str, key: str, value=None):
+        """
+        Записывает изменение свойства в _properties_changes_ ({"add": [...], "update": [...], "delete": [...]}),
+        схлопывая его с уже накопленным изменением того же свойства:
+        повторные add/update оставляют последнее значение, add + delete взаимно уничтожаются,
+        delete + add превращаются в update
+        """
+        changes = self._properties_changes_
+        previous = None
+        for name, items in list(changes.items()):
+            for index, item in enumerate(items):
+                if item["group"] == group and item["key"] == key:
+                    previous = name
+                    del items[index]
+                    if not items:
+                        del changes[name]
+                    break
+            if previous is not None:
+                break
+        if operation == "delete":
+            if previous == "add":
+                return
+            changes.setdefault("delete", []).append({"group": group, "key": key})
+            return
+        if previous == "add" or (previous is None and operation == "add"):
+            operation = "add"
         else:
-            if not "update" in self._properties_changes_:
-                self._properties_changes_["update"] = []
-            self._properties_changes_["update"].append({
-                "group": group,
-                "key": key,
-                "value": value
-            })
+            operation = "update"
+        changes.setdefault(operation, []).append({"group": group, "key": key, "value": value})
+
+    def property_set(self, group, key, value):
+        """
+        Изменяет значение свойства, при отсутствии свойства (или группы) создаёт его
+        """
+        values = self._body_properties_().setdefault(group, {})
+        operation = "update" if key in values else "add"
+        values[key] = value
+        self._record_property_change_(operation, group, key, value)
+        self._mark_dirty_()
 
     def property_create(self, group, key, value=""):
-        pass
+        self.property_set(group, key, value)
 
     def property_delete(self, group, key):
-        pass
+        values = self._body_properties_().get(group)
+        if isinstance(values, dict):
+            values.pop(key, None)
+        self._record_property_change_("delete", group, key)
+        self._mark_dirty_()
+
+
+def _node_from_data(data: dict) -> Node:
+    return Node(**{key: value for key, value in data.items() if key in Node._defaults_})
+
+
+def _take_changes(obj: DataNode) -> typing.Callable[[], None]:
+    """
+    Забирает из объекта накопленные изменения полей и свойств (перед их отправкой).
+    Возвращает функцию, которая возвращает их обратно, если отправка не удалась
+    """
+    changes = dict(obj.changes)
+    obj.changes.clear()
+    properties_changes = {key: list(value) for key, value in getattr(obj, "_properties_changes_", {}).items()}
+    if properties_changes:
+        obj._properties_changes_.clear()
+
+    def restore():
+        for key, value in changes.items():
+            obj.changes.setdefault(key, value)
+        if properties_changes:
+            # неотправленные изменения старше сделанных после отправки - проигрываем их заново по порядку
+            newer = {key: list(value) for key, value in obj._properties_changes_.items()}
+            obj._properties_changes_.clear()
+            for recorded in (properties_changes, newer):
+                for operation, items in recorded.items():
+                    for item in items:
+                        obj._record_property_change_(operation, item["group"], item["key"], item.get("value"))
+
+    return restore
+
+
+_draft_keys = itertools.count(1)
+
+
+@dataclass
+class NodeDraft:
+    """
+    NodeDraft - узел, который ещё не создан на сервере. key - временный идентификатор,
+    parent - key другого NodeDraft или id уже существующего узла
+    """
+    key: str
+    parent: str
+    properties: dict = field(default_factory=dict)
+    position: list = None
+
+    @staticmethod
+    def new_key() -> str:
+        return f"draft:{next(_draft_keys)}"
+
+    @staticmethod
+    def from_tree(tree: typing.Union[dict, typing.Iterable[dict]], parent: str) -> typing.Iterator["NodeDraft"]:
+        """
+        Черновики из вложенных словарей {"title" или "properties", "position", "children": [...]}
+        """
+        stack = [(item, parent) for item in reversed([tree] if isinstance(tree, dict) else list(tree))]
+        while stack:
+            item, item_parent = stack.pop()
+            properties = item.get("properties")
+            if properties is None:
+                properties = {"global": {"title": item.get("title", "")}}
+            draft = NodeDraft(item.get("key") or NodeDraft.new_key(), item_parent, properties, item.get("position"))
+            yield draft
+            stack.extend((child, draft.key) for child in reversed(item.get("children") or ()))
+
+    @staticmethod
+    def from_outline(lines: typing.Iterable[str], parent: str) -> typing.Iterator["NodeDraft"]:
+        """
+        Черновики из текстового плана: строка - заголовок узла, вложенность задаётся отступом
+        """
+        stack = []
+        for line in lines:
+            title = line.strip()
+            if not title:
+                continue
+            indent = len(line) - len(line.lstrip())
+            while stack and stack[-1][0] >= indent:
+                stack.pop()
+            draft = NodeDraft(NodeDraft.new_key(), stack[-1][1] if stack else parent, {"global": {"title": title}})
+            stack.append((indent, draft.key))
+            yield draft
 
 
 class Nodes:
@@ -432,49 +1528,153 @@ class Nodes:
         data = {
             "map_id": map_id,
             "parent": parent,
-            "properties": json.dumps(properties),
-            "position": json.dumps(position),
+            "properties": properties,
+            "position": position,
         }
         action = Action(self.session, 'POST', f'/api/nodes', data)
         response = await action.async_send()
-
-        args = dict(**json.loads(response[1]))
-        node = Node(**args)
-        node.changes.clear()
-        return node
+        if response[0] != 200:
+            _log_response_error("Nodes.create", response)
+            return None
+        return _node_from_data(response[1])
 
     def create(self, *args, **kwargs):
-        return self.session.loop.run_until_complete(self.async_create(*args, **kwargs))
+        return self.session.run(self.async_create(*args, **kwargs))
+
+    async def async_create_tree(self, map_id: str, drafts: typing.Iterable[NodeDraft], max_actions: int = 100,
+                                concurrency: int = 4) -> typing.Dict[str, typing.Optional[Node]]:
+        """
+        Создаёт множество узлов через /api/batch, не дожидаясь ответа на каждый узел отдельно.
+        Узел отправляется, как только известен серверный id его родителя, поэтому независимые ветки
+        создаются параллельно (до concurrency пачек по max_actions узлов одновременно).
+        Дети одного родителя создаются по порядку. Возвращает key -> Node, для неудавшихся узлов
+        и их потомков - None
+        """
+        drafts = list(drafts)
+        keys = {draft.key for draft in drafts}
+        waiting = collections.defaultdict(list)
+        groups = collections.OrderedDict()
+        for draft in drafts:
+            if draft.parent in keys:
+                waiting[draft.parent].append(draft)
+            else:
+                groups.setdefault(draft.parent, []).append(draft)
+        # очередь групп детей (id родителя на сервере, черновики)
+        ready = collections.deque(groups.items())
+        created = {}
+
+        def take_chunk():
+            chunk = []
+            rest = None
+            while ready and len(chunk) < max_actions:
+                parent, group = ready.popleft()
+                room = max_actions - len(chunk)
+                if len(group) > room:
+                    # остаток группы ждёт эту пачку, чтобы не нарушить порядок детей
+                    group, rest = group[:room], (parent, group[room:])
+                chunk.extend((draft, parent) for draft in group)
+            return chunk, rest
+
+        async def send(chunk):
+            actions = tuple(Action(self.session, 'POST', '/api/nodes', {
+                "map_id": map_id,
+                "parent": parent,
+                "properties": draft.properties,
+                "position": draft.position or ["R", -1],
+            }) for draft, parent in chunk)
+            return await Sequence(self.session, actions, max_actions=max_actions).async_execute()
+
+        def fail(key):
+            stack = [key]
+            while stack:
+                current = stack.pop()
+                created[current] = None
+                stack.extend(child.key for child in waiting.pop(current, ()))
+
+        tasks = {}
+        try:
+            while ready or tasks:
+                while ready and len(tasks) < concurrency:
+                    chunk, rest = take_chunk()
+                    tasks[asyncio.ensure_future(send(chunk))] = (chunk, rest)
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    chunk, rest = tasks.pop(task)
+                    try:
+                        results = task.result()
+                    except Exception as e:
+                        # пачка не дошла до сервера - её узлы и их потомки считаются несозданными,
+                        # уже созданные узлы остаются в результате
+                        logging.error(f"Nodes.create_tree, error: {e!r}")
+                        results = [ActionResult(None, 0, e)] * len(chunk)
+                    else:
+                        _log_failed_results("Nodes.create_tree", results)
+                    if rest is not None:
+                        ready.appendleft(rest)
+                    for (draft, _), result in zip(chunk, results):
+                        if not result.ok or not isinstance(result.body, dict):
+                            fail(draft.key)
+                            continue
+                        node = _node_from_data(result.body)
+                        created[draft.key] = node
+                        children = waiting.pop(draft.key, None)
+                        if children:
+                            ready.append((node.id, children))
+        finally:
+            for task in tasks:
+                task.cancel()
+        for key in list(waiting):
+            fail(key)
+        return created
+
+    def create_tree(self, map_id: str, drafts: typing.Iterable[NodeDraft], max_actions: int = 100,
+                    concurrency: int = 4) -> typing.Dict[str, typing.Optional[Node]]:
+        return self.session.run(self.async_create_tree(map_id, drafts, max_actions, concurrency))
 
     async def async_update(self, *nodes: typing.List[Node]):
+        """
+        Отправляет изменения узлов. Отправленные изменения из узлов забираются,
+        а если действие не удалось - возвращаются в узел для повторной отправки
+        """
         actions = []
+        rollbacks = []
         for node in nodes:
-            if len(node.changes.keys()) > 0:
-                action = Action(self.session, 'PATCH', f'/api/nodes/{node.id}', node.changes)
-                actions.append(action)
-                pass
-            if len(node._properties_changes_.keys()) > 0:
-                # update
-                if "update" in node._properties_changes_:
-                    data = {
-                        "properties": json.dumps(node._properties_changes_)
-                    }
-                    action = Action(self.session, 'PATCH', f'/api/nodes/{node.id}', data)
-                    actions.append(action)
+            node_actions = self._update_actions(node)
+            if node_actions:
+                restore = _take_changes(node)
+                actions.extend(node_actions)
+                rollbacks.extend([restore] * len(node_actions))
 
         if len(actions) > 0:
             sequence = Sequence(self.session, tuple(actions))
-            response = await sequence.async_send()
-            # print(response)
-            if response[0] != 200:
-                if response[0] != 404:
-                    data = json.loads(response[1])
-                    logging.error(f"node.update, code: {data['code']}, message: {data['message']}")
-                else:
-                    logging.error(f"node.update, " + str(response))
+            try:
+                results = await sequence.async_execute()
+            except Exception:
+                for rollback in rollbacks:
+                    rollback()
+                raise
+            for result, rollback in zip(results, rollbacks):
+                if not result.ok:
+                    rollback()
+            _log_failed_results("Nodes.update", results)
+            _reindex(nodes)
+            return results
+        return []
+
+    def _update_actions(self, node: Node) -> typing.List[Action]:
+        """
+        Одно действие PATCH на узел: изменённые поля и накопленные изменения свойств вместе
+        """
+        data = dict(node.changes)
+        properties_changes = node._lazy__properties_changes_
+        if properties_changes:
+            data["properties"] = {operation: list(items) for operation, items in properties_changes.items()}
+        if not data:
+            return []
+        return [Action(self.session, 'PATCH', f'/api/nodes/{node.id}', data)]
 
     def update(self, *nodes: typing.List[Node]):
-        self.session.loop.run_until_complete(self.async_update(*nodes))
+        return self.session.run(self.async_update(*nodes))
 
     async def async_get_by_id(self, node_id: str):
         request = Request(self.session, "GET", f"/api/nodes/{node_id}")
@@ -483,11 +1683,629 @@ class Nodes:
             logging.error(f'{self.__class__.__name__}.get_by_id' + str(response))
             return None
         else:
-
-            args = dict(**response[1])
-            node = Node(**args)
-            node.changes.clear()
-            return node
+            return _node_from_data(response[1])
 
     def get_by_id(self, node_id: str):
-        return self.session.loop.run_until_complete(self.async_get_by_id(node_id))
+        return self.session.run(self.async_get_by_id(node_id))
+
+    async def async_get_many(self, node_ids: typing.Iterable[str], concurrency: int = None) -> list:
+        """
+        Загружает несколько объектов параллельно, не более concurrency запросов одновременно.
+        Результаты возвращаются в порядке node_ids: объект, None при ошибке сервера или исключение
+        """
+        return await _gather_limited(self.session, self.async_get_by_id, node_ids, concurrency)
+
+    def get_many(self, node_ids: typing.Iterable[str], concurrency: int = None) -> list:
+        return self.session.run(self.async_get_many(node_ids, concurrency))
+
+    async def async_iter_many(self, node_ids: typing.Iterable[str], concurrency: int = None):
+        """
+        То же, что async_get_many, но отдаёт пары (node_id, результат) по мере завершения запросов
+        """
+        node_ids = list(node_ids)
+        async for index, result in _iter_limited(self.session, self.async_get_by_id, node_ids, concurrency):
+            yield node_ids[index], result
+
+    async def _async_get_subtree(self, map_id: str, node_id: str, level_count: int = None):
+        url = f"/api/maps/{map_id}/nodes/{node_id}"
+        if level_count is not None:
+            url += f"?level_count={level_count}"
+        # деревья большие и устаревают от изменения любого узла в них - в кэш их не кладём
+        response = await Request(self.session, "GET", url, cached=False).async_send()
+        if response[0] != 200:
+            logging.error(f'{self.__class__.__name__}.iter_tree' + str(response))
+            return None
+        return response[1]
+
+    async def async_iter_tree(self, map_id: str, node_id: str, order: str = "bfs", max_depth: int = None,
+                              chunk_depth: int = None):
+        """
+        Лениво обходит поддерево узла node_id (включая его самого) в порядке "bfs" или "dfs" и отдаёт Node.
+        max_depth ограничивает глубину обхода относительно node_id.
+        chunk_depth - сколько уровней загружать одним запросом: глубже лежащие ветки догружаются
+        отдельными запросами по мере обхода, поэтому в памяти не держится вся карта сразу.
+        У отдаваемых узлов body["children"] удаляется, связь с родителем доступна через Node.parent
+        """
+        if order not in ("bfs", "dfs"):
+            raise ValueError(f"Unknown tree order: {order}")
+        if chunk_depth is not None and chunk_depth < 1:
+            raise ValueError(f"chunk_depth must be positive: {chunk_depth}")
+        bfs = order == "bfs"
+
+        def levels(depth):
+            if max_depth is None:
+                return chunk_depth
+            if chunk_depth is None:
+                return max_depth - depth
+            return min(chunk_depth, max_depth - depth)
+
+        def children_items(data, depth, boundary):
+            body = data.get("body")
+            children = body.pop("children", None) if isinstance(body, dict) else None
+            if max_depth is not None and depth >= max_depth:
+                return []
+            if children:
+                return [(child, depth + 1, boundary) for child in children]
+            leaf = (data.get("meta") or {}).get("leaf")
+            if boundary is not None and depth >= boundary and not leaf:
+                # дети не вошли в загруженный кусок - догрузим их отдельным запросом
+                return [(None, depth, data.get("id"))]
+            return []
+
+        root_levels = levels(0)
+        root = await self._async_get_subtree(map_id, node_id, root_levels)
+        if root is None:
+            return
+        queue = collections.deque([(root, 0, root_levels)])
+        while queue:
+            data, depth, boundary = queue.popleft() if bfs else queue.pop()
+            if data is None:
+                # boundary здесь хранит id узла, чьи дети ещё не загружены
+                level_count = levels(depth)
+                subtree = await self._async_get_subtree(map_id, boundary, level_count)
+                if subtree is None:
+                    continue
+                items = children_items(subtree, depth, None if level_count is None else depth + level_count)
+                if bfs:
+                    queue.extendleft(reversed(items))
+                else:
+                    queue.extend(reversed(items))
+                continue
+            items = children_items(data, depth, boundary)
+            yield _node_from_data(data)
+            queue.extend(items if bfs else reversed(items))
+
+    def get_tree(self, map_id: str, node_id: str, order: str = "bfs", max_depth: int = None,
+                 chunk_depth: int = None) -> typing.List[Node]:
+        async def collect():
+            return [node async for node in self.async_iter_tree(map_id, node_id, order, max_depth, chunk_depth)]
+
+        return self.session.run(collect())
+
+
+class UnitOfWork:
+    """
+    UnitOfWork - отслеживает изменения объектов User, Map и Node и отправляет их пачками через /api/batch.
+    Объекты регистрируются методом track, после чего любое изменение поля помечает объект как изменённый.
+    Повторные изменения одного поля до отправки схлопываются в одно. Изменения отправляются:
+    - когда изменённых объектов набирается max_pending (внутри цикла событий - в фоне,
+      в синхронном коде - сразу, в том же вызове);
+    - каждые interval секунд (только внутри async with);
+    - при вызове flush/async_flush и при выходе из контекстного менеджера.
+    Если действие не удалось, его изменения возвращаются в объект и будут отправлены при следующей отправке
+    """
+
+    def __init__(self, session: Session, max_pending: int = 500, interval: float = 1.0,
+                 max_actions: int = 100, concurrency: int = 1):
+        self.session = session
+        self.max_pending = max_pending
+        self.interval = interval
+        self.max_actions = max_actions
+        self.concurrency = concurrency
+        self._dirty = {}
+        self._lock = None
+        self._timer = None
+        self._pending_flush = None
+
+    def track(self, *objects: DataNode):
+        for obj in objects:
+            object.__setattr__(obj, "_unit_of_work_", self)
+            if obj.has_changes():
+                self.mark_dirty(obj)
+
+    def untrack(self, *objects: DataNode):
+        for obj in objects:
+            object.__setattr__(obj, "_unit_of_work_", None)
+            self._dirty.pop(id(obj), None)
+
+    def mark_dirty(self, obj: DataNode):
+        self._dirty[id(obj)] = obj
+        if len(self._dirty) < self.max_pending or (self._pending_flush is not None and not self._pending_flush.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            self._pending_flush = loop.create_task(self.async_flush())
+            return
+        # синхронный код: отправляем сразу (при sync=True - на цикле сессии в её потоке, см. Session.run).
+        # Ждём отправки, а не уходим в фон, чтобы не забирать изменения объектов одновременно с их изменением
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error(f"UnitOfWork.flush, error: {e!r}")
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def _take_actions(self, obj: DataNode) -> list:
+        """
+        Забирает накопленные изменения объекта и строит по ним действия.
+        Возвращает пары (действие, функция отката изменений)
+        """
+        if isinstance(obj, User):
+            actions = Users(self.session)._update_actions(obj)
+        elif isinstance(obj, Map):
+            actions = Maps(self.session)._update_actions(obj)
+        elif isinstance(obj, Node):
+            actions = Nodes(self.session)._update_actions(obj)
+        else:
+            return []
+        if not actions:
+            # изменения, которые нельзя отправить (например, чужого User), остаются в объекте
+            return []
+        restore_changes = _take_changes(obj)
+
+        def restore():
+            restore_changes()
+            self._dirty[id(obj)] = obj
+
+        return [(action, restore) for action in actions]
+
+    async def async_flush(self) -> typing.List[ActionResult]:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            dirty = list(self._dirty.values())
+            self._dirty.clear()
+            actions = []
+            rollbacks = []
+            for obj in dirty:
+                for action, rollback in self._take_actions(obj):
+                    actions.append(action)
+                    rollbacks.append(rollback)
+            if len(actions) == 0:
+                return []
+            sequence = Sequence(self.session, tuple(actions), max_actions=self.max_actions,
+                                concurrency=self.concurrency)
+            try:
+                results = await sequence.async_execute()
+            except Exception:
+                for rollback in rollbacks:
+                    rollback()
+                raise
+            for result, rollback in zip(results, rollbacks):
+                if not result.ok:
+                    rollback()
+            _log_failed_results("UnitOfWork.flush", results)
+            _reindex([obj for obj in dirty if isinstance(obj, Node)])
+            return results
+
+    def flush(self) -> typing.List[ActionResult]:
+        return self.session.run(self.async_flush())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.async_flush()
+            except Exception as e:
+                logging.error(f"UnitOfWork.flush, error: {e!r}")
+
+    async def __aenter__(self):
+        if self.interval:
+            self._timer = asyncio.ensure_future(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending_flush is not None:
+            await asyncio.wait([self._pending_flush])
+        await self.async_flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+
+@dataclass
+class Event:
+    """
+    Event - информация о событии на карте
+    """
+    NODE_CREATED = "node_created"
+    NODE_UPDATED = "node_updated"
+    NODE_MOVED = "node_moved"
+    NODE_DELETED = "node_deleted"
+    BRANCH_DELETED = "branch_deleted"
+    MAP_UPDATED = "map_updated"
+
+    type: str = ""
+    map_id: str = ""
+    node_id: str = ""
+    user_id: str = ""
+    version: int = 0
+    data: dict = field(default_factory=dict)
+
+    @staticmethod
+    def from_data(data: dict, map_id: str = "", version: int = 0) -> "Event":
+        what = data.get("what")
+        payload = data.get("data") if isinstance(data.get("data"), dict) else {}
+        if isinstance(what, dict):
+            payload = what
+            what = None
+        node = payload.get("node") if isinstance(payload.get("node"), dict) else {}
+        node_id = what or payload.get("node_id") or payload.get("id") or node.get("id") or data.get("node_id") or ""
+        who = data.get("who") if isinstance(data.get("who"), dict) else {}
+        args = {
+            "type": data.get("type", ""),
+            "map_id": data.get("map_id", map_id),
+            "node_id": node_id,
+            "user_id": who.get("id") or data.get("user_id", ""),
+            "version": version,
+            "data": data,
+        }
+        return Event(**args)
+
+    @property
+    def node(self) -> typing.Optional[dict]:
+        """
+        Данные узла, если сервер прислал их вместе с событием
+        """
+        payload = self.data.get("data")
+        if isinstance(payload, dict) and isinstance(payload.get("node"), dict):
+            return payload["node"]
+        if isinstance(self.data.get("node"), dict):
+            return self.data["node"]
+        return None
+
+
+def _index_value(value):
+    """
+    Ключ значения свойства в индексе: списки и словари приводятся к строке JSON
+    """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return value
+
+
+def _text_tokens(text) -> typing.Set[str]:
+    if not isinstance(text, str):
+        return set()
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def _reindex(nodes: typing.Iterable[Node]):
+    """
+    Обновляет индексы MapTree, в которых лежат узлы, после отправки их изменений
+    """
+    for node in nodes:
+        tree = node._map_tree_
+        if tree is not None:
+            tree.add(node)
+
+
+class MapTree:
+    """
+    MapTree - локальная копия дерева узлов карты. Можно загрузить целиком через async_load
+    и поддерживать в актуальном состоянии, применяя к ней события (async_apply).
+    Кроме связей родитель -> дети, дерево индексирует узлы по значениям свойств (find)
+    и по словам заголовка (search). Индексы обновляются при add/remove, при событиях
+    и после отправки изменений узлов через Nodes.update или UnitOfWork
+    """
+
+    def __init__(self, map_id: str, nodes: typing.Iterable[Node] = ()):
+        self.map_id = map_id
+        self.nodes = {}
+        self.children = collections.defaultdict(list)
+        self._properties = collections.defaultdict(dict)
+        self._tokens = collections.defaultdict(set)
+        self._indexed = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    async def async_load(session: Session, map_id: str, chunk_depth: int = None) -> "MapTree":
+        tree = MapTree(map_id)
+        async for node in Maps(session).async_iter_nodes(map_id, chunk_depth=chunk_depth):
+            tree.add(node)
+        return tree
+
+    def add(self, node: Node):
+        """
+        Добавляет узел или заменяет узел с тем же id, переиндексируя его
+        """
+        old = self.nodes.get(node.id)
+        if old is not None:
+            # родитель берётся из индекса: при переиндексации тот же объект уже хранит нового родителя
+            old_parent = self._unindex(node.id)
+            if old_parent != node.parent and node.id in self.children.get(old_parent, ()):
+                self.children[old_parent].remove(node.id)
+            if old is not node:
+                object.__setattr__(old, "_map_tree_", None)
+        self.nodes[node.id] = node
+        object.__setattr__(node, "_map_tree_", self)
+        siblings = self.children[node.parent]
+        if node.id not in siblings:
+            siblings.append(node.id)
+        self._index(node)
+
+    def _index(self, node: Node):
+        keys = []
+        tokens = set()
+        properties = node.body.get("properties") if isinstance(node.body, dict) else None
+        if isinstance(properties, dict):
+            for group, values in properties.items():
+                if not isinstance(values, dict):
+                    continue
+                for key, value in values.items():
+                    value = _index_value(value)
+                    self._properties[(group, key)].setdefault(value, set()).add(node.id)
+                    keys.append((group, key, value))
+            tokens = _text_tokens((properties.get("global") or {}).get("title"))
+        for token in tokens:
+            self._tokens[token].add(node.id)
+        self._indexed[node.id] = (keys, tokens, node.parent)
+
+    def _unindex(self, node_id: str) -> typing.Optional[str]:
+        """
+        Убирает узел из индексов, возвращает родителя, под которым он был проиндексирован
+        """
+        keys, tokens, parent = self._indexed.pop(node_id, ((), (), None))
+        for group, key, value in keys:
+            values = self._properties[(group, key)]
+            ids = values.get(value)
+            if ids is not None:
+                ids.discard(node_id)
+                if not ids:
+                    del values[value]
+        for token in tokens:
+            ids = self._tokens[token]
+            ids.discard(node_id)
+            if not ids:
+                del self._tokens[token]
+        return parent
+
+    def remove(self, node_id: str) -> typing.List[Node]:
+        """
+        Удаляет узел вместе с веткой, возвращает удалённые узлы
+        """
+        node = self.nodes.get(node_id)
+        if node is None:
+            return []
+        indexed = self._indexed.get(node_id)
+        siblings = self.children.get(indexed[2] if indexed is not None else node.parent)
+        if siblings is not None and node_id in siblings:
+            siblings.remove(node_id)
+        removed = []
+        stack = [node_id]
+        while stack:
+            current = stack.pop()
+            removed_node = self.nodes.pop(current, None)
+            if removed_node is not None:
+                object.__setattr__(removed_node, "_map_tree_", None)
+                self._unindex(current)
+                removed.append(removed_node)
+            stack.extend(self.children.pop(current, ()))
+        return removed
+
+    def get(self, node_id: str) -> typing.Optional[Node]:
+        return self.nodes.get(node_id)
+
+    def get_children(self, node_id: str) -> typing.List[Node]:
+        return [self.nodes[child] for child in self.children.get(node_id, ()) if child in self.nodes]
+
+    def get_parent(self, node_id: str) -> typing.Optional[Node]:
+        node = self.nodes.get(node_id)
+        return None if node is None else self.nodes.get(node.parent)
+
+    def find(self, group: str, key: str, value=None) -> typing.List[Node]:
+        """
+        Узлы, у которых свойство group/key равно value. Без value - все узлы, у которых свойство есть
+        """
+        values = self._properties.get((group, key))
+        if not values:
+            return []
+        if value is None:
+            ids = set().union(*values.values())
+        else:
+            ids = values.get(_index_value(value), ())
+        return [self.nodes[node_id] for node_id in ids]
+
+    def search(self, text: str) -> typing.List[Node]:
+        """
+        Узлы, в заголовке которых есть все слова из text (без учёта регистра)
+        """
+        tokens = _text_tokens(text)
+        if not tokens:
+            return []
+        sets = sorted((self._tokens.get(token, set()) for token in tokens), key=len)
+        ids = sets[0].intersection(*sets[1:])
+        return [self.nodes[node_id] for node_id in ids]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    async def async_apply(self, session: Session, event: Event):
+        """
+        Применяет событие к дереву. Если сервер не прислал данные узла, догружается только этот узел
+        """
+        if event.map_id and event.map_id != self.map_id:
+            return
+        if event.type in (Event.NODE_DELETED, Event.BRANCH_DELETED):
+            self.remove(event.node_id)
+        elif event.type in (Event.NODE_CREATED, Event.NODE_UPDATED, Event.NODE_MOVED) and event.node_id:
+            data = event.node
+            if data is not None:
+                node = _node_from_data(data)
+            else:
+                node = await Nodes(session).async_get_by_id(event.node_id)
+            if node is not None:
+                self.add(node)
+
+
+_NO_RETRY = RetryPolicy(attempts=1)
+
+
+class Listener:
+    """
+    Listener - отслеживание событий на карте (создание, удаление, модификация узлов и веток).
+    Ожидает события длинным опросом (long polling) ключа уведомлений карты в KV-хранилище RedForester,
+    превращает их в Event и параллельно передаёт всем подписанным обработчикам.
+    Если передан tree (MapTree), события сначала применяются к нему
+    """
+
+    def __init__(self, session: Session, map_id: str, kv_session: str = None, tree: MapTree = None,
+                 poll_timeout: float = 60, retry_delay: float = 1):
+        self.session = session
+        self.map_id = map_id
+        self.kv_session = kv_session
+        self.tree = tree
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.version = None
+        self.handlers = collections.defaultdict(list)
+        self._task = None
+        self._running = False
+
+    def add_handler(self, handler, *types: str):
+        """
+        Подписывает обработчик (функцию или корутину, принимающую Event) на события types, без types - на все
+        """
+        for event_type in types or ("*",):
+            self.handlers[event_type].append(handler)
+
+    def on(self, *types: str):
+        def decorator(handler):
+            self.add_handler(handler, *types)
+            return handler
+
+        return decorator
+
+    def _url(self) -> str:
+        url = f"/kv/keys/mapNotifLast:{self.map_id}:{self.kv_session}"
+        if self.version is not None:
+            url += f"?waitVersion={self.version}"
+        return url
+
+    def _decode(self, data: dict) -> typing.List[Event]:
+        version = int(data.get("version", 0) or 0)
+        value = data.get("value")
+        if isinstance(value, str):
+            try:
+                value = self.session.codec.loads(value)
+            except ValueError:
+                logging.error(f"Listener.poll, bad event: {value}")
+                return []
+        if isinstance(value, dict):
+            value = [value]
+        if not isinstance(value, list):
+            return []
+        return [Event.from_data(item, self.map_id, version) for item in value if isinstance(item, dict)]
+
+    async def async_poll(self) -> typing.List[Event]:
+        """
+        Один цикл длинного опроса: ждёт изменения версии и возвращает новые события
+        """
+        if self.kv_session is None:
+            user = await Users(self.session).async_get()
+            if user is None:
+                return []
+            self.kv_session = user.kv_session
+        # опрос без изменений заканчивается по таймауту - это не ошибка и не повод повторять запрос
+        request = Request(self.session, "GET", self._url(), timeout=self.poll_timeout, cached=False,
+                          retry=_NO_RETRY)
+        try:
+            response = await request.async_send()
+        except asyncio.TimeoutError:
+            return []
+        if response[0] != 200 or not isinstance(response[1], dict):
+            logging.error("Listener.poll, " + str(response))
+            await asyncio.sleep(self.retry_delay)
+            return []
+        first = self.version is None
+        version = response[1].get("version")
+        if version is None or version == self.version:
+            return []
+        self.version = version
+        if first:
+            # первое обращение только узнаёт текущую версию, старые события не отдаются
+            return []
+        return self._decode(response[1])
+
+    async def dispatch(self, event: Event):
+        if self.tree is not None:
+            await self.tree.async_apply(self.session, event)
+        handlers = self.handlers.get(event.type, []) + self.handlers.get("*", [])
+        coroutines = []
+        for handler in handlers:
+            try:
+                result = handler(event)
+            except Exception as e:
+                logging.error(f"Listener.dispatch, handler: {handler!r}, error: {e!r}")
+                continue
+            if asyncio.iscoroutine(result):
+                coroutines.append(result)
+        for handler_result in await asyncio.gather(*coroutines, return_exceptions=True):
+            if isinstance(handler_result, Exception):
+                logging.error(f"Listener.dispatch, error: {handler_result!r}")
+
+    async def async_run(self):
+        self._running = True
+        while self._running:
+            try:
+                events = await self.async_poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Listener.run, error: {e!r}")
+                await asyncio.sleep(self.retry_delay)
+                continue
+            for event in events:
+                await self.dispatch(event)
+
+    def run(self):
+        self.session.run(self.async_run())
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.ensure_future(self.async_run())
+        return self._task
+
+    async def async_stop(self):
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stop(self):
+        self._running = False
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.async_stop()
@@ -0,0 +1,192 @@
+import collections
+import time
+import typing
+from dataclasses import dataclass
+
+
+@dataclass
+class CacheEntry:
+    body: bytes
+    etag: typing.Optional[str]
+    expires: float
+
+
+class Cache:
+    """
+    Cache - кэш ответов на GET-запросы с вытеснением давно не использованных записей (LRU) и временем жизни (TTL).
+    Ключ - url ресурса. Хранится тело ответа, поэтому каждый запрос получает собственную копию данных.
+    Просроченная запись с ETag не удаляется сразу, а перепроверяется запросом с If-None-Match.
+    max_size ограничивает число записей, max_bytes - суммарный размер тел ответов.
+    Ответ GET-запроса, во время которого ресурс был изменён (invalidate), не сохраняется: запрос отмечается
+    через begin, а put получает версию, которую вернул begin
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30, max_bytes: int = 64 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._index = collections.defaultdict(set)
+        # url выполняющегося запроса -> [число таких запросов, версия]
+        self._pending = {}
+
+    @staticmethod
+    def _tokens(url: str) -> typing.List[str]:
+        """
+        Пары соседних сегментов пути: "/api/maps/m/nodes/n" -> ["api/maps", "maps/m", "m/nodes", "nodes/n"]
+        """
+        segments = [segment for segment in url.split("?", 1)[0].split("/") if segment]
+        return [f"{left}/{right}" for left, right in zip(segments, segments[1:])]
+
+    def lookup(self, url: str) -> typing.Tuple[typing.Optional[CacheEntry], bool]:
+        """
+        Возвращает запись и признак её свежести. Просроченная запись без ETag удаляется
+        """
+        entry = self._entries.get(url)
+        if entry is None:
+            self.misses += 1
+            return None, False
+        if entry.expires > time.monotonic():
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry, True
+        self.misses += 1
+        if entry.etag is None:
+            self._remove(url)
+            return None, False
+        return entry, False
+
+    def begin(self, url: str) -> int:
+        """
+        Отмечает начало запроса url, возвращает версию для put. Каждый begin завершается end
+        """
+        pending = self._pending.get(url)
+        if pending is None:
+            pending = self._pending[url] = [0, 0]
+        pending[0] += 1
+        return pending[1]
+
+    def end(self, url: str):
+        pending = self._pending.get(url)
+        if pending is not None:
+            pending[0] -= 1
+            if pending[0] <= 0:
+                del self._pending[url]
+
+    def put(self, url: str, body: bytes, etag: str = None, version: int = None):
+        if self.max_size <= 0 or (self.max_bytes is not None and len(body) > self.max_bytes):
+            return
+        if version is not None and url in self._pending and self._pending[url][1] != version:
+            # ресурс изменён после начала запроса - ответ мог устареть
+            return
+        old = self._entries.get(url)
+        if old is not None:
+            self._entries.move_to_end(url)
+            self.size_bytes -= len(old.body)
+        else:
+            for token in self._tokens(url):
+                self._index[token].add(url)
+        self._entries[url] = CacheEntry(body, etag, time.monotonic() + self.ttl)
+        self.size_bytes += len(body)
+        while len(self._entries) > self.max_size or \
+                (self.max_bytes is not None and self.size_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def revalidate(self, url: str) -> typing.Optional[CacheEntry]:
+        """
+        Сервер ответил 304 Not Modified - продлеваем жизнь записи
+        """
+        entry = self._entries.get(url)
+        if entry is not None:
+            entry.expires = time.monotonic() + self.ttl
+            self._entries.move_to_end(url)
+            self.revalidations += 1
+        return entry
+
+    @staticmethod
+    def _path(url: str) -> str:
+        return url.split("?", 1)[0].rstrip("/")
+
+    @classmethod
+    def affected(cls, url: str, candidates: typing.Iterable[str], collection: bool = False) -> typing.Set[str]:
+        """
+        Выбирает из candidates url, затронутые изменением ресурса url: сам ресурс, всё, что вложено в него,
+        и коллекцию, в которой он лежит. Изменение узла (/api/nodes/...) затрагивает и все деревья карт
+        (/api/maps/{map}/nodes/...): узел может входить в любое из них.
+        collection=True - в коллекцию url добавлен ресурс (POST): затронута только сама коллекция
+        """
+        path = cls._path(url)
+        tokens = cls._tokens(url)
+        affected = set()
+        for candidate in candidates:
+            candidate_path = cls._path(candidate)
+            if collection or not tokens:
+                if candidate_path == path:
+                    affected.add(candidate)
+                continue
+            candidate_tokens = cls._tokens(candidate)
+            if tokens[-1] in candidate_tokens:
+                affected.add(candidate)
+            elif tokens[0] == "api/nodes" and candidate_tokens[:1] == ["api/maps"] \
+                    and candidate_path.split("/")[4:5] == ["nodes"]:
+                affected.add(candidate)
+            elif len(tokens) > 1 and tokens[-2] in candidate_tokens and candidate_path.endswith("/" + tokens[-2]):
+                affected.add(candidate)
+        return affected
+
+    def invalidate(self, url: str, collection: bool = False):
+        """
+        Сбрасывает записи, затронутые изменением ресурса url (см. affected)
+        """
+        tokens = self._tokens(url)
+        if not tokens:
+            return
+        candidates = set(self._index.get(tokens[-1], ()))
+        if not collection:
+            if tokens[0] == "api/nodes":
+                candidates.update(self._index.get("api/maps", ()))
+            if len(tokens) > 1:
+                candidates.update(self._index.get(tokens[-2], ()))
+        for key_url in self.affected(url, candidates, collection):
+            if key_url in self._entries:
+                self._remove(key_url)
+                self.invalidations += 1
+        for key_url in self.affected(url, self._pending, collection):
+            self._pending[key_url][1] += 1
+
+    def _remove(self, url: str):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.size_bytes -= len(entry.body)
+        for token in self._tokens(url):
+            urls = self._index.get(token)
+            if urls is not None:
+                urls.discard(url)
+                if not urls:
+                    del self._index[token]
+
+    def clear(self):
+        self._entries.clear()
+        self._index.clear()
+        self.size_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
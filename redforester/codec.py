@@ -0,0 +1,68 @@
+import json
+import typing
+
+
+class JsonCodec:
+    """
+    JsonCodec - кодирование и разбор JSON стандартной библиотекой. loads принимает bytes или str,
+    dumps возвращает bytes, чтобы тело запроса не перекодировалось повторно
+    """
+    name = "json"
+
+    def loads(self, data: typing.Union[bytes, str]):
+        return json.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def loads(self, data: typing.Union[bytes, str]):
+        return self._orjson.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return self._orjson.dumps(obj)
+
+
+class UjsonCodec(JsonCodec):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def loads(self, data: typing.Union[bytes, str]):
+        return self._ujson.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return self._ujson.dumps(obj, ensure_ascii=False).encode()
+
+
+CODECS = {
+    "json": JsonCodec,
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+}
+
+
+def get_codec(codec: typing.Union[str, JsonCodec, None] = None) -> JsonCodec:
+    """
+    Возвращает кодек по имени ("json", "orjson", "ujson") или сам переданный кодек.
+    Без аргумента выбирается самый быстрый из установленных: orjson, ujson, затем стандартный json
+    """
+    if isinstance(codec, JsonCodec):
+        return codec
+    if codec is not None:
+        return CODECS[codec]()
+    for name in ("orjson", "ujson"):
+        try:
+            return CODECS[name]()
+        except ImportError:
+            continue
+    return JsonCodec()
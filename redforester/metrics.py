@@ -0,0 +1,199 @@
+import bisect
+import logging
+import re
+import time
+import typing
+from dataclasses import dataclass, field
+
+import aiohttp
+
+
+@dataclass
+class RequestMetrics:
+    """
+    RequestMetrics - замеры одной HTTP-попытки Request/Action/Sequence. Времена - в секундах:
+    queue_wait - ожидание ограничителей сессии и свободного соединения в пуле,
+    connect - установка нового соединения (DNS, TCP, TLS), ttfb - от отправки до заголовков ответа,
+    body - чтение тела, decode - разбор JSON, total - всё вместе
+    """
+    kind: str
+    method: str
+    url: str
+    attempt: int = 1
+    status: int = 0
+    request_bytes: int = 0
+    response_bytes: int = 0
+    reused: bool = False
+    queue_wait: float = 0.0
+    connect: float = 0.0
+    ttfb: float = 0.0
+    body: float = 0.0
+    decode: float = 0.0
+    total: float = 0.0
+    error: str = ""
+    started: float = field(default_factory=time.perf_counter)
+    _mark: float = 0.0
+
+    @property
+    def endpoint(self) -> str:
+        return normalize_url(self.url)
+
+
+_ID_SEGMENT = re.compile(r"^(?=.*\d)[\w-]+$|^[\w-]{16,}$")
+
+
+def normalize_url(url: str) -> str:
+    """
+    Заменяет идентификаторы в пути на {id}: "/api/nodes/1c2f...?x=1" -> "/api/nodes/{id}"
+    """
+    path = url.split("?", 1)[0]
+    return "/".join("{id}" if index > 2 and _ID_SEGMENT.match(segment) else segment
+                    for index, segment in enumerate(path.split("/")))
+
+
+def trace_config() -> aiohttp.TraceConfig:
+    """
+    TraceConfig для aiohttp, заполняющий RequestMetrics, переданный как trace_request_ctx
+    """
+    config = aiohttp.TraceConfig()
+
+    async def on_queued_start(session, context, params):
+        metrics = context.trace_request_ctx
+        if isinstance(metrics, RequestMetrics):
+            metrics._mark = time.perf_counter()
+
+    async def on_queued_end(session, context, params):
+        metrics = context.trace_request_ctx
+        if isinstance(metrics, RequestMetrics):
+            metrics.queue_wait += time.perf_counter() - metrics._mark
+
+    async def on_create_start(session, context, params):
+        metrics = context.trace_request_ctx
+        if isinstance(metrics, RequestMetrics):
+            metrics._mark = time.perf_counter()
+
+    async def on_create_end(session, context, params):
+        metrics = context.trace_request_ctx
+        if isinstance(metrics, RequestMetrics):
+            metrics.connect += time.perf_counter() - metrics._mark
+
+    async def on_reuse(session, context, params):
+        metrics = context.trace_request_ctx
+        if isinstance(metrics, RequestMetrics):
+            metrics.reused = True
+
+    config.on_connection_queued_start.append(on_queued_start)
+    config.on_connection_queued_end.append(on_queued_end)
+    config.on_connection_create_start.append(on_create_start)
+    config.on_connection_create_end.append(on_create_end)
+    config.on_connection_reuseconn.append(on_reuse)
+    return config
+
+
+def emit(hooks: list, metrics: RequestMetrics):
+    for hook in hooks:
+        try:
+            hook(metrics)
+        except Exception as e:
+            logging.error(f"Session hook {hook!r}, error: {e!r}")
+
+
+class Histogram:
+    """
+    Histogram - гистограмма значений с фиксированными границами корзин
+    """
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, bounds: typing.Sequence[float] = BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Верхняя граница корзины, в которую попадает percent процентов значений
+        """
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class MetricsCollector:
+    """
+    MetricsCollector - встроенный обработчик замеров: счётчики и гистограммы задержек по каждому
+    эндпоинту ("GET /api/nodes/{id}"). Подключается через Session(hooks=[collector]) или session.add_hook
+    """
+    PHASES = ("queue_wait", "connect", "ttfb", "body", "decode", "total")
+
+    def __init__(self, bounds: typing.Sequence[float] = Histogram.BOUNDS):
+        self.bounds = bounds
+        self.endpoints = {}
+
+    def __call__(self, metrics: RequestMetrics):
+        key = f"{metrics.method} {metrics.endpoint}"
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = {
+                "requests": 0,
+                "errors": 0,
+                "retries": 0,
+                "reused": 0,
+                "statuses": {},
+                "request_bytes": 0,
+                "response_bytes": 0,
+                "phases": {phase: Histogram(self.bounds) for phase in self.PHASES},
+            }
+            self.endpoints[key] = stats
+        stats["requests"] += 1
+        if metrics.error or metrics.status >= 400:
+            stats["errors"] += 1
+        if metrics.attempt > 1:
+            stats["retries"] += 1
+        if metrics.reused:
+            stats["reused"] += 1
+        stats["statuses"][metrics.status] = stats["statuses"].get(metrics.status, 0) + 1
+        stats["request_bytes"] += metrics.request_bytes
+        stats["response_bytes"] += metrics.response_bytes
+        for phase in self.PHASES:
+            stats["phases"][phase].add(getattr(metrics, phase))
+
+    def snapshot(self) -> dict:
+        return {
+            key: dict(stats, statuses=dict(stats["statuses"]),
+                      phases={phase: histogram.snapshot() for phase, histogram in stats["phases"].items()})
+            for key, stats in self.endpoints.items()
+        }
+
+    def slowest(self, count: int = 10, phase: str = "total", percent: float = 99) -> typing.List[tuple]:
+        """
+        Эндпоинты с наибольшей задержкой: [(эндпоинт, значение percent-перцентиля фазы), ...]
+        """
+        values = [(key, stats["phases"][phase].percentile(percent)) for key, stats in self.endpoints.items()]
+        return sorted(values, key=lambda item: item[1], reverse=True)[:count]
+
+    def reset(self):
+        self.endpoints.clear()
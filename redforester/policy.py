@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+import email.utils
+import random
+import time
+import typing
+
+
+class RetryPolicy:
+    """
+    RetryPolicy - правила повтора запросов.
+    Идемпотентные запросы (GET, PUT, DELETE...) повторяются при кодах из retry_statuses и ошибках соединения,
+    остальные - только при 429, когда сервер гарантированно не выполнил запрос.
+    Задержка растёт экспоненциально (backoff * 2^попытка, не больше max_backoff) со случайным разбросом,
+    заголовок Retry-After имеет приоритет
+    """
+    IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+    def __init__(self, attempts: int = 3, backoff: float = 0.5, max_backoff: float = 30, jitter: bool = True,
+                 retry_statuses: typing.Iterable[int] = (429, 500, 502, 503, 504)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def should_retry(self, method: str, attempt: int, status: int = None) -> bool:
+        """
+        attempt - номер уже выполненной попытки, начиная с 1; status None означает ошибку соединения
+        """
+        if attempt >= self.attempts:
+            return False
+        if status == 429:
+            return True
+        if method.upper() not in self.IDEMPOTENT_METHODS:
+            return False
+        return status is None or status in self.retry_statuses
+
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after:
+            delay = parse_retry_after(retry_after)
+            if delay is not None:
+                return min(delay, self.max_backoff)
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+def parse_retry_after(value: str) -> typing.Optional[float]:
+    """
+    Retry-After бывает числом секунд или HTTP-датой
+    """
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """
+    TokenBucket - ограничение частоты запросов: в среднем не больше rate запросов в секунду,
+    кратковременно - до burst запросов подряд
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+        if self._lock is None or self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class AdaptiveLimiter:
+    """
+    AdaptiveLimiter - ограничение числа одновременных запросов, подстраивающееся под сервер (AIMD):
+    каждый успешный ответ увеличивает лимит примерно на increase за "окно" запросов,
+    ошибка или ответ медленнее latency_threshold уменьшает лимит в decrease раз
+    """
+
+    def __init__(self, initial: int = 10, minimum: int = 1, maximum: int = 100, increase: float = 1,
+                 decrease: float = 0.5, latency_threshold: float = None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.in_flight = 0
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_event_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, success: bool, latency: float = 0):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if not success or (self.latency_threshold is not None and latency > self.latency_threshold):
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            condition.notify_all()
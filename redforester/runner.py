@@ -0,0 +1,197 @@
+"""
+Обработка множества карт в нескольких процессах. Каждый процесс держит свою Session со своим циклом
+событий и пулом соединений, карты раздаются процессам по одной по мере освобождения,
+результаты и ошибки собираются в главном процессе.
+
+    python -m redforester.runner --username user --out snapshots --processes 8 map-1 map-2 ...
+"""
+import argparse
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+import traceback
+import typing
+from dataclasses import dataclass, field
+
+from . import Maps, Session
+from .config import PRODUCTION_CONFIG, Config
+
+Credentials = typing.Tuple[str, str]
+
+# сессия процесса-обработчика, создаётся в _init_worker
+_worker_session = None
+
+
+def _init_worker(credentials: typing.List[Credentials], counter, config: Config, options: dict):
+    global _worker_session
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    username, password = credentials[index % len(credentials)]
+    _worker_session = Session(username, password, config=config, **options)
+    # atexit в процессах пула не срабатывает (они завершаются через os._exit), Finalize - срабатывает
+    multiprocessing.util.Finalize(None, _worker_session.close, exitpriority=10)
+
+
+def _run_job(job: typing.Callable, map_id: str) -> typing.Tuple[str, typing.Any, float]:
+    started = time.perf_counter()
+    try:
+        result = _worker_session.run(job(_worker_session, map_id))
+    except Exception as e:
+        # исключение может не пережить передачу между процессами - отдаём его текстом
+        raise RuntimeError(f"{e!r}\n{traceback.format_exc()}") from None
+    return map_id, result, time.perf_counter() - started
+
+
+class ExportJob:
+    """
+    ExportJob - задание для MapRunner: сохраняет карту в файл снимка directory/<map_id>.rfs
+    (см. Maps.export) и возвращает {"path": ..., "nodes": ...}
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    async def __call__(self, session: Session, map_id: str) -> dict:
+        path = os.path.join(self.directory, f"{map_id}.rfs")
+        count = await Maps(session).async_export(map_id, path)
+        if count is None:
+            raise RuntimeError(f"Map {map_id} was not exported")
+        return {"path": path, "nodes": count}
+
+
+@dataclass
+class RunResult:
+    """
+    RunResult - результат обработки одной карты: result задания или текст ошибки error
+    """
+    map_id: str
+    result: typing.Any = None
+    error: str = None
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class RunReport:
+    """
+    RunReport - сводка по всем картам: сколько обработано, результаты и ошибки по map_id
+    """
+    total: int = 0
+    done: int = 0
+    results: typing.Dict[str, typing.Any] = field(default_factory=dict)
+    errors: typing.Dict[str, str] = field(default_factory=dict)
+    seconds: float = 0.0
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+    def add(self, result: RunResult):
+        self.done += 1
+        if result.ok:
+            self.results[result.map_id] = result.result
+        else:
+            self.errors[result.map_id] = result.error
+
+
+class MapRunner:
+    """
+    MapRunner - выполняет задание job(session, map_id) для каждой карты в пуле из processes процессов.
+    job - асинхронная функция верхнего уровня модуля или объект с async __call__ (например, ExportJob),
+    передаётся в процессы через pickle. Процессы по очереди берут учётные записи из credentials,
+    options передаются в конструктор Session каждого процесса (cache, retry, scheduler...).
+    Результат задания тоже передаётся через pickle, поэтому большие данные лучше писать в файлы,
+    а возвращать сводку
+    """
+
+    def __init__(self, credentials: typing.Union[Credentials, typing.List[Credentials]],
+                 config: Config = PRODUCTION_CONFIG, processes: int = None, options: dict = None):
+        self.credentials = [credentials] if isinstance(credentials, tuple) else list(credentials)
+        if not self.credentials:
+            raise ValueError("At least one (username, password) pair is required")
+        self.config = config
+        self.processes = processes or os.cpu_count() or 1
+        self.options = dict(options or {})
+        self.options.setdefault("logs", None)
+
+    def iter_run(self, job: typing.Callable, map_ids: typing.Iterable[str]) -> typing.Iterator[RunResult]:
+        """
+        Отдаёт RunResult по мере завершения карт (в порядке завершения, а не map_ids)
+        """
+        map_ids = list(map_ids)
+        counter = multiprocessing.Value("i", 0)
+        with concurrent.futures.ProcessPoolExecutor(self.processes, initializer=_init_worker,
+                                                    initargs=(self.credentials, counter, self.config,
+                                                              self.options)) as executor:
+            # в очереди пула держим не больше двух карт на процесс, остальные отправляем по мере освобождения
+            pending_ids = iter(map_ids)
+            futures = {}
+            for map_id in itertools.islice(pending_ids, self.processes * 2):
+                futures[executor.submit(_run_job, job, map_id)] = map_id
+            while futures:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    map_id = futures.pop(future)
+                    try:
+                        _, result, seconds = future.result()
+                        yield RunResult(map_id, result, seconds=seconds)
+                    except Exception as e:
+                        logging.error(f"MapRunner, map: {map_id}, error: {str(e).splitlines()[0]}")
+                        yield RunResult(map_id, error=str(e))
+                    for next_id in itertools.islice(pending_ids, 1):
+                        futures[executor.submit(_run_job, job, next_id)] = next_id
+
+    def run(self, job: typing.Callable, map_ids: typing.Iterable[str],
+            progress: typing.Callable[[RunReport, RunResult], None] = None) -> RunReport:
+        """
+        Обрабатывает все карты и возвращает сводку. progress(report, result) вызывается после каждой карты
+        """
+        map_ids = list(map_ids)
+        report = RunReport(total=len(map_ids))
+        started = time.perf_counter()
+        for result in self.iter_run(job, map_ids):
+            report.add(result)
+            report.seconds = time.perf_counter() - started
+            if progress is not None:
+                progress(report, result)
+        return report
+
+    def export(self, map_ids: typing.Iterable[str], directory: str,
+               progress: typing.Callable[[RunReport, RunResult], None] = None) -> RunReport:
+        os.makedirs(directory, exist_ok=True)
+        return self.run(ExportJob(directory), map_ids, progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export RedForester maps to snapshot files in parallel")
+    parser.add_argument("map_ids", nargs="*", help="карты; без аргументов - все карты пользователя")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", default=os.environ.get("REDFORESTER_PASSWORD", ""))
+    parser.add_argument("--out", default="snapshots")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    map_ids = args.map_ids
+    if not map_ids:
+        with Session(args.username, args.password, logs=None) as session:
+            maps = Maps(session).get_all() or []
+        map_ids = [map.id for map in maps]
+
+    def progress(report: RunReport, result: RunResult):
+        status = "ok" if result.ok else "error"
+        print(f"[{report.done}/{report.total}] {result.map_id} {status} {result.seconds:.1f}s", flush=True)
+
+    report = MapRunner((args.username, args.password), processes=args.processes).export(map_ids, args.out, progress)
+    print(f"done: {report.done - report.failed}, failed: {report.failed}, {report.seconds:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
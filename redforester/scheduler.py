@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import time
+import typing
+
+INTERACTIVE = "interactive"
+NORMAL = "normal"
+BULK = "bulk"
+
+_current_priority = contextvars.ContextVar("redforester_priority", default=None)
+
+
+class PriorityClass:
+    """
+    PriorityClass - класс приоритета: budget - сколько его запросов может выполняться одновременно,
+    weight - доля свободных слотов, которую он получает при конкуренции с другими классами
+    """
+
+    def __init__(self, name: str, budget: int, weight: float):
+        self.name = name
+        self.budget = budget
+        self.weight = weight
+        self.active = 0
+        self.waiting = collections.deque()
+        self.granted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.virtual_time = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.budget,
+            "active": self.active,
+            "queued": len(self.waiting),
+            "granted": self.granted,
+            "wait_mean": self.wait_total / self.granted if self.granted else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+class Scheduler:
+    """
+    Scheduler - очередь запросов сессии с классами приоритета (interactive, normal, bulk).
+    Одновременно выполняется не больше limit запросов, запросов одного класса - не больше его budget.
+    Освободившийся слот достаётся классу с наименьшим "виртуальным временем" (взвешенная справедливая
+    очередь): при конкуренции interactive получает слоты чаще, но bulk не останавливается совсем.
+    Приоритет запроса - Request(priority=...), иначе заданный через session.priority(...), иначе default
+    """
+
+    def __init__(self, limit: int = 30, classes: typing.Dict[str, typing.Tuple[int, float]] = None,
+                 default: str = NORMAL):
+        if classes is None:
+            classes = {
+                INTERACTIVE: (limit, 8),
+                NORMAL: (max(1, limit * 2 // 3), 4),
+                BULK: (max(1, limit // 2), 1),
+            }
+        self.limit = limit
+        self.default = default
+        self.classes = {name: PriorityClass(name, budget, weight) for name, (budget, weight) in classes.items()}
+        if default not in self.classes:
+            raise ValueError(f"Unknown priority class: {default}")
+        self.active = 0
+
+    def resolve(self, priority: str = None) -> str:
+        priority = priority or _current_priority.get() or self.default
+        if priority not in self.classes:
+            raise ValueError(f"Unknown priority class: {priority}")
+        return priority
+
+    async def acquire(self, priority: str = None) -> str:
+        """
+        Ждёт свободного слота, возвращает класс, который затем передаётся в release
+        """
+        name = self.resolve(priority)
+        priority_class = self.classes[name]
+        if not priority_class.waiting:
+            # класс, простаивавший в очереди, не копит "кредит" на будущее
+            busy = [other.virtual_time for other in self.classes.values() if other.waiting]
+            if busy:
+                priority_class.virtual_time = max(priority_class.virtual_time, min(busy))
+        future = asyncio.get_event_loop().create_future()
+        priority_class.waiting.append((future, time.monotonic()))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # слот уже выдан, но ожидающий отменён - возвращаем слот
+                self.release(name)
+            else:
+                self._forget(priority_class, future)
+            raise
+        return name
+
+    def release(self, priority: str):
+        self.classes[priority].active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    def _forget(self, priority_class: PriorityClass, future: asyncio.Future):
+        for index, (waiting, _) in enumerate(priority_class.waiting):
+            if waiting is future:
+                del priority_class.waiting[index]
+                break
+
+    def _dispatch(self):
+        while self.active < self.limit:
+            candidates = [priority_class for priority_class in self.classes.values()
+                          if priority_class.waiting and priority_class.active < priority_class.budget]
+            if not candidates:
+                return
+            priority_class = min(candidates, key=lambda candidate: candidate.virtual_time)
+            future, queued = priority_class.waiting.popleft()
+            if future.done():
+                continue
+            wait = time.monotonic() - queued
+            priority_class.active += 1
+            priority_class.granted += 1
+            priority_class.wait_total += wait
+            priority_class.wait_max = max(priority_class.wait_max, wait)
+            priority_class.virtual_time += 1 / priority_class.weight
+            self.active += 1
+            future.set_result(None)
+
+    def queue_depth(self) -> int:
+        return sum(len(priority_class.waiting) for priority_class in self.classes.values())
+
+    def stats(self) -> dict:
+        return {name: priority_class.stats() for name, priority_class in self.classes.items()}
+
+
+@contextlib.contextmanager
+def priority(name: str):
+    """
+    Задаёт приоритет всех запросов внутри блока (и запущенных из него задач)
+    """
+    token = _current_priority.set(name)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
@@ -0,0 +1,343 @@
+"""
+Локальный сервер, имитирующий API RedForester: /api/user, /api/maps, /api/nodes, /api/batch
+и ключи уведомлений /kv/keys. Нужен для тестов и бенчмарков без доступа к настоящему серверу.
+
+    python -m redforester.server --port 8765 --maps 1 --nodes 10000 --latency 0.005 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import typing
+import urllib.parse
+import uuid
+
+from aiohttp import web
+
+from .config import Config
+
+
+class LocalConfig(Config):
+    PROTOCOL = "http"
+
+    def __init__(self, host: str, port: int):
+        self.BASIC_URL = f"{host}:{port}"
+
+
+class LocalServer:
+    """
+    LocalServer - сервер-заглушка RedForester в памяти.
+    Создаёт maps карт по nodes узлов (каждый узел имеет до branching детей).
+    latency - задержка каждого HTTP-ответа в секундах, error_rate - доля запросов, на которые
+    отвечается error_status. Все запросы подсчитываются в stats
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, maps: int = 1, nodes: int = 100, branching: int = 10,
+                 latency: float = 0, error_rate: float = 0, error_status: int = 503, seed: int = None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.user = {
+            "user_id": "user-0",
+            "username": "user@example.com",
+            "name": "Local",
+            "surname": "User",
+            "avatar": "",
+            "registration_date": 0,
+            "birthday": 0,
+            "kv_session": "kv-session",
+            "is_extension_user": False,
+        }
+        self.maps = {}
+        self.nodes = {}
+        self.children = {}
+        self.stats = {}
+        self.kv = {}
+        self._condition = None
+        self._runner = None
+        for index in range(maps):
+            self.add_map(f"map-{index}", nodes, branching)
+
+    @property
+    def config(self) -> Config:
+        return LocalConfig(self.host, self.port)
+
+    def add_map(self, map_id: str, nodes: int = 100, branching: int = 10) -> dict:
+        root_id = f"{map_id}-node-0"
+        self.maps[map_id] = {
+            "id": map_id,
+            "root_node_id": root_id,
+            "owner": self.user["user_id"],
+            "owner_name": self.user["name"],
+            "owner_avatar": "",
+            "layout": "LR",
+            "public": False,
+            "node_count": nodes,
+            "user_count": 1,
+            "name": map_id,
+        }
+        self._add_node(map_id, root_id, "", 0, 0)
+        for index in range(1, nodes):
+            parent = f"{map_id}-node-{(index - 1) // branching}"
+            self._add_node(map_id, f"{map_id}-node-{index}", parent, self.nodes[parent]["nodelevel"] + 1,
+                           len(self.children[parent]))
+        return self.maps[map_id]
+
+    def _add_node(self, map_id: str, node_id: str, parent: str, level: int, position: int,
+                  properties: dict = None) -> dict:
+        node = {
+            "id": node_id,
+            "map_id": map_id,
+            "parent": parent,
+            "position": ["R", position],
+            "access": "user_all",
+            "originalParent": parent,
+            "body": {
+                "id": node_id,
+                "properties": properties or {"global": {"title": f"Node {node_id}"}, "style": {}, "byType": {}},
+            },
+            "hidden": False,
+            "readers": [self.user["user_id"]],
+            "nodelevel": level,
+            "meta": {"author": self.user["user_id"], "editable": True},
+        }
+        self.nodes[node_id] = node
+        self.children[node_id] = []
+        if parent:
+            self.children[parent].append(node_id)
+        return node
+
+    def _node_view(self, node_id: str, level_count: int = None) -> dict:
+        node = dict(self.nodes[node_id])
+        children = self.children[node_id]
+        node["meta"] = dict(node["meta"], leaf=len(children) == 0)
+        body = dict(node["body"])
+        if level_count is None or level_count > 0:
+            body["children"] = [self._node_view(child, None if level_count is None else level_count - 1)
+                                for child in children]
+        else:
+            body["children"] = []
+        node["body"] = body
+        return node
+
+    def _remove_node(self, node_id: str):
+        node = self.nodes.pop(node_id)
+        for child in self.children.pop(node_id):
+            self._remove_node(child)
+        if node["parent"] in self.children:
+            self.children[node["parent"]].remove(node_id)
+
+    def _notify(self, map_id: str, event_type: str, node_id: str, node: dict = None):
+        key = f"mapNotifLast:{map_id}"
+        version, _ = self.kv.get(key, (0, None))
+        event = {"type": event_type, "what": node_id, "who": {"id": self.user["user_id"]}}
+        if node is not None:
+            event["data"] = {"node": node}
+        self.kv[key] = (version + 1, json.dumps(event))
+        if self._condition is not None:
+            asyncio.ensure_future(self._wake())
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def _wake(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    @staticmethod
+    def _properties(value) -> dict:
+        if isinstance(value, str):
+            value = json.loads(value)
+        return value or {}
+
+    def _update_node(self, node: dict, body: dict):
+        for key, value in body.items():
+            if key == "properties":
+                changes = self._properties(value)
+                properties = node["body"]["properties"]
+                for change in changes.get("add", []) + changes.get("update", []):
+                    properties.setdefault(change["group"], {})[change["key"]] = change["value"]
+                for change in changes.get("delete", []):
+                    properties.get(change["group"], {}).pop(change["key"], None)
+            elif key in ("id", "map_id", "body", "meta"):
+                continue
+            elif key == "parent" and value != node["parent"]:
+                self.children[node["parent"]].remove(node["id"])
+                self.children[value].append(node["id"])
+                node["parent"] = value
+            else:
+                node[key] = value
+
+    def handle(self, method: str, path: str, query: typing.Mapping = None, body=None) -> typing.Tuple[int, typing.Any]:
+        """
+        Выполняет запрос к API без HTTP. Используется и обычными запросами, и /api/batch
+        """
+        path, _, query_string = path.partition("?")
+        if query is None:
+            query = dict(urllib.parse.parse_qsl(query_string))
+        parts = [part for part in path.split("/") if part]
+        if len(parts) < 2 or parts[0] != "api":
+            return 404, {"code": "404", "message": f"Unknown url {path}"}
+        resource = parts[1]
+        args = parts[2:]
+        if resource == "user":
+            if not args and method == "GET":
+                return 200, self.user
+            if not args and method == "PATCH":
+                self.user.update({key: value for key, value in (body or {}).items() if key in self.user})
+                return 200, self.user
+            if len(args) == 1 and method == "GET":
+                if args[0] != self.user["user_id"]:
+                    return 404, {"code": "0104", "message": "User not found"}
+                return 200, self.user
+        elif resource == "maps":
+            if not args and method == "GET":
+                return 200, list(self.maps.values())
+            if not args and method == "POST":
+                map_id = str(uuid.uuid4())
+                self.add_map(map_id, 1)
+                self.maps[map_id].update({key: value for key, value in (body or {}).items() if key in ("name", "layout")})
+                return 200, self.maps[map_id]
+            map = self.maps.get(args[0])
+            if map is None:
+                return 404, {"code": "0201", "message": "Map not found"}
+            if len(args) == 1 and method == "GET":
+                return 200, map
+            if len(args) == 1 and method == "PATCH":
+                map.update({key: value for key, value in (body or {}).items() if key in ("name", "layout", "public")})
+                self._notify(map["id"], "map_updated", map["root_node_id"])
+                return 200, map
+            if len(args) == 3 and args[1] == "nodes" and method == "GET":
+                if args[2] not in self.nodes:
+                    return 404, {"code": "0301", "message": "Node not found"}
+                level_count = query.get("level_count")
+                return 200, self._node_view(args[2], None if level_count is None else int(level_count))
+        elif resource == "nodes":
+            if not args and method == "POST":
+                body = body or {}
+                parent = self.nodes.get(body.get("parent"))
+                if parent is None:
+                    return 404, {"code": "0301", "message": "Parent node not found"}
+                properties = self._properties(body.get("properties"))
+                node = self._add_node(parent["map_id"], str(uuid.uuid4()), parent["id"], parent["nodelevel"] + 1,
+                                      len(self.children[parent["id"]]), properties or None)
+                self._notify(node["map_id"], "node_created", node["id"], node)
+                return 200, node
+            node = self.nodes.get(args[0]) if args else None
+            if node is None:
+                return 404, {"code": "0301", "message": "Node not found"}
+            if method == "GET":
+                return 200, node
+            if method == "PATCH":
+                self._update_node(node, body or {})
+                self._notify(node["map_id"], "node_updated", node["id"], node)
+                return 200, node
+            if method == "DELETE":
+                self._remove_node(node["id"])
+                self._notify(node["map_id"], "branch_deleted", node["id"])
+                return 200, {}
+        elif resource == "batch" and method == "POST":
+            results = []
+            for item in body or []:
+                item_body = item.get("body")
+                if isinstance(item_body, str):
+                    item_body = json.loads(item_body) if item_body else None
+                status, result = self.handle(item["method"], item["url"], body=item_body)
+                results.append({"status": status, "body": json.dumps(result)})
+            return 200, results
+        return 404, {"code": "404", "message": f"Unknown url {method} {path}"}
+
+    async def _kv(self, request: web.Request) -> web.Response:
+        map_id = request.match_info["key"].split(":")[1]
+        key = f"mapNotifLast:{map_id}"
+        wait_version = request.query.get("waitVersion")
+        if wait_version is not None:
+            condition = self._get_condition()
+            async with condition:
+                try:
+                    await asyncio.wait_for(condition.wait_for(
+                        lambda: self.kv.get(key, (0, None))[0] != int(wait_version)), 30)
+                except asyncio.TimeoutError:
+                    pass
+        version, value = self.kv.get(key, (0, None))
+        return web.json_response({"version": version, "value": value})
+
+    async def _dispatch(self, request: web.Request) -> web.Response:
+        text = await request.text()
+        body = json.loads(text) if text else None
+        parts = request.path.split("/")
+        etag = None
+        if request.method == "GET" and len(parts) > 4 and parts[2] == "maps" and parts[4] == "nodes":
+            # версия дерева карты - номер последнего события карты
+            version, _ = self.kv.get(f"mapNotifLast:{parts[3]}", (0, None))
+            etag = f'"{parts[3]}-{version}"'
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+        status, result = self.handle(request.method, request.path, request.query, body)
+        response = web.json_response(result, status=status)
+        if etag is not None and status == 200:
+            response.headers["ETag"] = etag
+        return response
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = f"{request.method} {request.path.split('/')[2] if request.path.count('/') > 1 else request.path}"
+        self.stats[route] = self.stats.get(route, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({"code": str(self.error_status), "message": "Injected error"},
+                                     status=self.error_status)
+        return await handler(request)
+
+    def application(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/kv/keys/{key}", self._kv)
+        app.router.add_route("*", "/api/{tail:.*}", self._dispatch)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.application())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local RedForester stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--maps", type=int, default=1)
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--branching", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    server = LocalServer(args.host, args.port, args.maps, args.nodes, args.branching, args.latency, args.error_rate,
+                         args.error_status, args.seed)
+    web.run_app(server.application(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Снимок карты на диске. Формат - текстовый файл:
+первая строка - заголовок в JSON (карта, ETag дерева, время создания),
+дальше по строке на узел: "<node_id>\\t<JSON узла>\\n".
+Файл читается через mmap: при открытии строится только индекс id -> смещение,
+узлы разбираются по мере обращения к ним
+"""
+import datetime
+import json
+import mmap
+import os
+import typing
+from dataclasses import dataclass, field
+
+FORMAT = "redforester-snapshot"
+VERSION = 1
+
+
+def encode_node(node_id: str, data: dict) -> bytes:
+    return b"%s\t%s\n" % (node_id.encode(),
+                          json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode())
+
+
+@dataclass
+class SnapshotDiff:
+    """
+    SnapshotDiff - отличия карты на сервере от снимка: id добавленных, изменённых и удалённых узлов
+    """
+    added: typing.List[str] = field(default_factory=list)
+    updated: typing.List[str] = field(default_factory=list)
+    removed: typing.List[str] = field(default_factory=list)
+    unchanged: int = 0
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+
+class SnapshotWriter:
+    """
+    SnapshotWriter - запись снимка. Пишет во временный файл и атомарно заменяет им path при close()
+    """
+
+    def __init__(self, path: str, map_data: dict, etag: str = None):
+        self.path = path
+        self.count = 0
+        self._temporary = f"{path}.tmp"
+        self._file = open(self._temporary, "wb")
+        header = {
+            "format": FORMAT,
+            "version": VERSION,
+            "created": datetime.datetime.utcnow().isoformat(),
+            "etag": etag,
+            "map": map_data,
+        }
+        self._file.write(json.dumps(header, ensure_ascii=False).encode() + b"\n")
+
+    def add(self, node_id: str, data: dict):
+        self.add_line(encode_node(node_id, data))
+
+    def add_line(self, line: bytes):
+        self._file.write(line)
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+        os.replace(self._temporary, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._temporary)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class MapSnapshot:
+    """
+    MapSnapshot - чтение снимка карты через mmap.
+    node_factory и map_factory превращают словари в модели (по умолчанию отдаются словари)
+    """
+
+    def __init__(self, path: str, node_factory: typing.Callable = None, map_factory: typing.Callable = None):
+        self.path = path
+        self.node_factory = node_factory
+        self.map_factory = map_factory
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        end = self._mmap.find(b"\n")
+        self.header = json.loads(self._mmap[:end])
+        if self.header.get("format") != FORMAT:
+            raise ValueError(f"{path} is not a RedForester map snapshot")
+        self._start = end + 1
+        self._index = None
+
+    @property
+    def etag(self) -> typing.Optional[str]:
+        return self.header.get("etag")
+
+    @property
+    def map(self):
+        data = self.header["map"]
+        return self.map_factory(**data) if self.map_factory is not None else data
+
+    @property
+    def index(self) -> typing.Dict[str, typing.Tuple[int, int]]:
+        """
+        id узла -> (начало, конец) его строки в файле, строится при первом обращении
+        """
+        if self._index is None:
+            index = {}
+            data = self._mmap
+            position = self._start
+            size = len(data)
+            while position < size:
+                tab = data.find(b"\t", position)
+                end = data.find(b"\n", tab)
+                if end < 0:
+                    end = size
+                index[data[position:tab].decode()] = (position, end + 1)
+                position = end + 1
+            self._index = index
+        return self._index
+
+    def line(self, node_id: str) -> typing.Optional[bytes]:
+        """
+        Строка узла как есть, без разбора JSON
+        """
+        bounds = self.index.get(node_id)
+        if bounds is None:
+            return None
+        return self._mmap[bounds[0]:bounds[1]]
+
+    def get_data(self, node_id: str) -> typing.Optional[dict]:
+        line = self.line(node_id)
+        if line is None:
+            return None
+        return json.loads(line[line.index(b"\t") + 1:])
+
+    def get(self, node_id: str):
+        data = self.get_data(node_id)
+        if data is None or self.node_factory is None:
+            return data
+        return self.node_factory(data)
+
+    def iter_data(self) -> typing.Iterator[dict]:
+        data = self._mmap
+        position = self._start
+        size = len(data)
+        while position < size:
+            end = data.find(b"\n", position)
+            if end < 0:
+                end = size
+            line = data[position:end]
+            yield json.loads(line[line.index(b"\t") + 1:])
+            position = end + 1
+
+    def __iter__(self):
+        for data in self.iter_data():
+            yield data if self.node_factory is None else self.node_factory(data)
+
+    def ids(self) -> typing.Iterable[str]:
+        return self.index.keys()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, node_id):
+        return node_id in self.index
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,69 @@
+import asyncio
+import contextlib
+import threading
+import typing
+
+from aiohttp import web
+
+import redforester
+from redforester.server import LocalConfig, LocalServer
+
+
+@contextlib.asynccontextmanager
+async def serve(handlers: typing.Dict[typing.Tuple[str, str], typing.Callable], **options):
+    """
+    Поднимает aiohttp-приложение с обработчиками {(метод, путь): handler} и открывает к нему Session.
+    options передаются в Session, по умолчанию запросы не повторяются
+    """
+    application = web.Application()
+    for (method, path), handler in handlers.items():
+        application.router.add_route(method, path, handler)
+    runner = web.AppRunner(application)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    options.setdefault("logs", None)
+    options.setdefault("retry", redforester.RetryPolicy(attempts=1))
+    try:
+        async with redforester.Session("user", "password", config=LocalConfig("127.0.0.1", runner.addresses[0][1]),
+                                       **options) as session:
+            yield session
+    finally:
+        await runner.cleanup()
+
+
+class ServerThread:
+    """
+    LocalServer в отдельном потоке - для синхронного кода, который сам запускает циклы событий
+    (Session.run, asyncio.run). options передаются в LocalServer
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.server = None
+        self._stopping = None
+        self._thread = None
+
+    def start(self) -> LocalServer:
+        ready = threading.Event()
+
+        async def serve():
+            async with LocalServer(**self.options) as server:
+                self.server = server
+                self._stopping = asyncio.get_running_loop().create_future()
+                ready.set()
+                await self._stopping
+
+        self._thread = threading.Thread(target=asyncio.run, args=(serve(),))
+        self._thread.start()
+        ready.wait()
+        return self.server
+
+    def stop(self):
+        self._stopping.get_loop().call_soon_threadsafe(self._stopping.set_result, None)
+        self._thread.join()
+
+    def __enter__(self) -> LocalServer:
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
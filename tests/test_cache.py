@@ -0,0 +1,77 @@
+import unittest
+
+import redforester
+
+
+class CacheInvalidateTest(unittest.TestCase):
+    """
+    Какие записи кэша сбрасывает изменение ресурса
+    """
+
+    def setUp(self):
+        self.cache = redforester.Cache()
+        self.urls = [
+            "/api/maps",
+            "/api/maps/m1",
+            "/api/maps/m1/nodes/n1",
+            "/api/maps/m2/nodes/r2",
+            "/api/nodes/n1",
+            "/api/nodes/n2",
+            "/api/nodes/n3",
+            "/api/user",
+        ]
+        for url in self.urls:
+            self.cache.put(url, b"{}")
+
+    def remaining(self) -> list:
+        return [url for url in self.urls if self.cache.lookup(url)[0] is not None]
+
+    def test_node_change(self):
+        self.cache.invalidate("/api/nodes/n1")
+        self.assertEqual(self.remaining(), ["/api/maps", "/api/maps/m1", "/api/nodes/n2", "/api/nodes/n3",
+                                            "/api/user"])
+
+    def test_map_change(self):
+        self.cache.invalidate("/api/maps/m1")
+        self.assertEqual(self.remaining(), ["/api/maps/m2/nodes/r2", "/api/nodes/n1", "/api/nodes/n2",
+                                            "/api/nodes/n3", "/api/user"])
+
+    def test_post_to_collection_keeps_members(self):
+        self.cache.invalidate("/api/nodes", collection=True)
+        self.cache.invalidate("/api/maps", collection=True)
+        self.assertEqual(self.remaining(), self.urls[1:])
+
+    def test_created_node_invalidates_parent(self):
+        action = redforester.Action(None, "POST", "/api/nodes", {"map_id": "m1", "parent": "n2"})
+        self.assertEqual(action.targets(), [("/api/nodes", True), ("/api/nodes/n2", False)])
+        for url, collection in action.targets():
+            self.cache.invalidate(url, collection)
+        self.assertEqual(self.remaining(), ["/api/maps", "/api/maps/m1", "/api/nodes/n1", "/api/nodes/n3",
+                                            "/api/user"])
+
+
+class CachePendingTest(unittest.TestCase):
+    """
+    Ответ запроса, во время которого ресурс изменился, в кэш не попадает
+    """
+
+    def test_put_after_invalidate_is_skipped(self):
+        cache = redforester.Cache()
+        version = cache.begin("/api/nodes/n1")
+        cache.invalidate("/api/nodes/n1")
+        cache.put("/api/nodes/n1", b"{}", version=version)
+        cache.end("/api/nodes/n1")
+        self.assertEqual(len(cache), 0)
+
+    def test_put_without_changes_is_stored(self):
+        cache = redforester.Cache()
+        version = cache.begin("/api/nodes/n1")
+        cache.invalidate("/api/nodes/n2")
+        cache.put("/api/nodes/n1", b"{}", version=version)
+        cache.end("/api/nodes/n1")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache._pending, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import json
+import unittest
+
+from aiohttp import web
+
+import redforester
+from helpers import serve
+
+
+class ReadYourWritesTest(unittest.TestCase):
+    """
+    GET, отправленный после изменения ресурса, видит это изменение, даже если одновременно
+    выполнялся GET того же ресурса, начатый до изменения
+    """
+
+    def get_after_write(self, **options) -> list:
+        state = {"hidden": False}
+        delays = [0.3]
+
+        async def get_node(request):
+            # сервер читает состояние сразу, а отвечает (первый раз) с задержкой
+            body = json.dumps({"id": "n1", "hidden": state["hidden"]})
+            if delays:
+                await asyncio.sleep(delays.pop())
+            return web.Response(body=body, content_type="application/json")
+
+        async def patch_node(request):
+            state.update(await request.json())
+            return web.json_response({})
+
+        async def main():
+            handlers = {("GET", "/api/nodes/n1"): get_node, ("PATCH", "/api/nodes/n1"): patch_node}
+            async with serve(handlers, **options) as session:
+                slow_get = asyncio.ensure_future(redforester.Request(session, "GET", "/api/nodes/n1").async_send())
+                await asyncio.sleep(0.05)
+                await redforester.Action(session, "PATCH", "/api/nodes/n1", {"hidden": True}).async_send()
+                after = await redforester.Request(session, "GET", "/api/nodes/n1").async_send()
+                await slow_get
+                later = await redforester.Request(session, "GET", "/api/nodes/n1").async_send()
+                return [after[1]["hidden"], later[1]["hidden"]]
+        return asyncio.run(main())
+
+    def test_cache_does_not_store_response_older_than_write(self):
+        self.assertEqual(self.get_after_write(cache=redforester.Cache(), single_flight=False), [True, True])
+
+    def test_single_flight_does_not_join_request_older_than_write(self):
+        self.assertEqual(self.get_after_write(single_flight=True), [True, True])
+
+    def test_single_flight_with_cache(self):
+        self.assertEqual(self.get_after_write(cache=redforester.Cache(), single_flight=True), [True, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import json
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+import redforester
+from helpers import serve
+
+
+class IterItemsTest(unittest.TestCase):
+    """
+    Потоковое чтение JSON-массива Request.async_iter_items при любом разбиении ответа на куски
+    """
+
+    def iter_items(self, body: bytes, chunk_size: int, status: int = 200) -> list:
+        async def handler(request):
+            return web.Response(status=status, body=body, content_type="application/json")
+
+        async def main():
+            async with serve({("GET", "/api/items"): handler}) as session:
+                request = redforester.Request(session, "GET", "/api/items")
+                return [item async for item in request.async_iter_items(chunk_size)]
+        return asyncio.run(main())
+
+    def test_items_split_at_any_byte(self):
+        body = '[12.5, 7, 1e5, -0.5E-3, {"a": [1, "]"]}, "строка", true, null]'
+        expected = json.loads(body)
+        for chunk_size in (1, 2, 3, 5, 64):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.iter_items(body.encode(), chunk_size), expected)
+
+    def test_empty_array(self):
+        self.assertEqual(self.iter_items(b" [ ] ", 1), [])
+
+    def test_unclosed_array_raises(self):
+        for body in (b"[1, 2", b"[1, 2,", b""):
+            with self.subTest(body=body):
+                with self.assertRaises(ValueError):
+                    self.iter_items(body, 1)
+
+    def test_malformed_number_raises(self):
+        with self.assertRaises(ValueError):
+            self.iter_items(b"[12.]", 64)
+
+    def test_error_status_raises(self):
+        with self.assertRaises(aiohttp.ClientResponseError) as context:
+            self.iter_items(b"<html>unavailable</html>", 64, status=503)
+        self.assertEqual(context.exception.status, 503)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import time
+import unittest
+
+from aiohttp import web
+
+import redforester
+from helpers import serve
+
+
+class ListenerTest(unittest.TestCase):
+    """
+    Длинный опрос Listener: тихий опрос не повторяется, ошибки не останавливают цикл
+    """
+
+    def test_quiet_poll_is_not_retried(self):
+        polls = []
+
+        async def kv(request):
+            polls.append(request.query.get("waitVersion"))
+            if "waitVersion" in request.query:
+                # изменений нет - сервер держит опрос дольше таймаута клиента
+                await asyncio.sleep(0.6)
+            return web.json_response({"version": "1", "value": ""})
+
+        async def main():
+            async with serve({("GET", "/kv/keys/{key}"): kv}, retry=redforester.RetryPolicy()) as session:
+                listener = redforester.Listener(session, "map-0", kv_session="kv", poll_timeout=0.3)
+                await listener.async_poll()
+                started = time.perf_counter()
+                events = await listener.async_poll()
+                return events, time.perf_counter() - started
+        events, seconds = asyncio.run(main())
+        self.assertEqual(events, [])
+        self.assertLess(seconds, 0.6)
+        self.assertEqual(polls, [None, "1"])
+
+    def test_bad_body_does_not_stop_listener(self):
+        async def kv(request):
+            return web.json_response(["not", "a", "dict"])
+
+        async def main():
+            async with serve({("GET", "/kv/keys/{key}"): kv}) as session:
+                listener = redforester.Listener(session, "map-0", kv_session="kv", retry_delay=0.01)
+                task = listener.start()
+                await asyncio.sleep(0.2)
+                alive = not task.done()
+                await listener.async_stop()
+                return alive
+        self.assertTrue(asyncio.run(main()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+
+import redforester
+from redforester.server import LocalServer
+
+
+class PropertyChangesTest(unittest.TestCase):
+    """
+    Схлопывание изменений свойств узла в _properties_changes_
+    """
+
+    def test_set_on_missing_property_is_add(self):
+        node = redforester.Node()
+        node.property_set("custom", "a", 1)
+        self.assertEqual(node.body, {"properties": {"custom": {"a": 1}}})
+        self.assertEqual(node._properties_changes_, {"add": [{"group": "custom", "key": "a", "value": 1}]})
+
+    def test_set_on_existing_property_is_update(self):
+        node = redforester.Node(body={"properties": {"global": {"title": "old"}}})
+        node.property_set("global", "title", "new")
+        self.assertEqual(node._properties_changes_,
+                         {"update": [{"group": "global", "key": "title", "value": "new"}]})
+
+    def test_repeated_update_keeps_last_value(self):
+        node = redforester.Node(body={"properties": {"global": {"title": "old"}}})
+        for index in range(5):
+            node.property_set("global", "title", f"t{index}")
+        self.assertEqual(node._properties_changes_,
+                         {"update": [{"group": "global", "key": "title", "value": "t4"}]})
+
+    def test_add_then_update_stays_add(self):
+        node = redforester.Node()
+        node.property_create("custom", "a", "1")
+        node.property_set("custom", "a", "2")
+        self.assertEqual(node._properties_changes_, {"add": [{"group": "custom", "key": "a", "value": "2"}]})
+
+    def test_add_then_delete_cancels(self):
+        node = redforester.Node()
+        node.property_create("custom", "a", "1")
+        node.property_delete("custom", "a")
+        self.assertEqual(node._properties_changes_, {})
+        self.assertFalse(node.has_changes())
+
+    def test_delete_then_add_is_update(self):
+        node = redforester.Node(body={"properties": {"global": {"title": "old"}}})
+        node.property_delete("global", "title")
+        node.property_create("global", "title", "back")
+        self.assertEqual(node._properties_changes_,
+                         {"update": [{"group": "global", "key": "title", "value": "back"}]})
+
+    def test_update_then_delete_is_delete(self):
+        node = redforester.Node(body={"properties": {"global": {"title": "old"}}})
+        node.property_set("global", "title", "new")
+        node.property_delete("global", "title")
+        self.assertEqual(node._properties_changes_, {"delete": [{"group": "global", "key": "title"}]})
+        self.assertEqual(node.body["properties"]["global"], {})
+
+    def test_update_action_joins_fields_and_properties(self):
+        node = redforester.Node(id="node-1", body={"properties": {"global": {"title": "old"}}})
+        node.hidden = True
+        node.property_set("global", "title", "new")
+        actions = redforester.Nodes(None)._update_actions(node)
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0].url, "/api/nodes/node-1")
+        self.assertEqual(actions[0].data, {
+            "hidden": True,
+            "properties": {"update": [{"group": "global", "key": "title", "value": "new"}]},
+        })
+
+    def test_no_changes_no_actions(self):
+        node = redforester.Node(id="node-1")
+        self.assertEqual(redforester.Nodes(None)._update_actions(node), [])
+
+
+class NodesUpdateTest(unittest.TestCase):
+    """
+    Nodes.update забирает отправленные изменения и возвращает неотправленные
+    """
+
+    def run_with_server(self, scenario, **options):
+        async def main():
+            async with LocalServer(nodes=10) as server:
+                async with redforester.Session("user", "password", config=server.config, logs=None,
+                                               **options) as session:
+                    return await scenario(server, session)
+        return asyncio.run(main())
+
+    def test_sent_changes_are_cleared(self):
+        async def scenario(server, session):
+            nodes = redforester.Nodes(session)
+            node = await nodes.async_get_by_id("map-0-node-1")
+            node.hidden = True
+            node.property_set("custom", "a", "1")
+            results = await nodes.async_update(node)
+            self.assertEqual([result.status for result in results], [200])
+            self.assertFalse(node.has_changes())
+            self.assertEqual(server.nodes["map-0-node-1"]["body"]["properties"]["custom"], {"a": "1"})
+            self.assertEqual(await nodes.async_update(node), [])
+        self.run_with_server(scenario)
+
+    def test_failed_changes_are_kept(self):
+        async def scenario(server, session):
+            nodes = redforester.Nodes(session)
+            node = await nodes.async_get_by_id("map-0-node-1")
+            node.property_set("custom", "a", "1")
+            server.error_rate = 1.0
+            results = await nodes.async_update(node)
+            self.assertFalse(results[0].ok)
+            self.assertEqual(node._properties_changes_, {"add": [{"group": "custom", "key": "a", "value": "1"}]})
+            server.error_rate = 0
+            results = await nodes.async_update(node)
+            self.assertTrue(results[0].ok)
+            self.assertFalse(node.has_changes())
+        self.run_with_server(scenario, retry=redforester.RetryPolicy(attempts=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+
+import redforester
+from helpers import serve
+
+
+class ErrorResponseTest(unittest.TestCase):
+    """
+    Ответы с ошибкой не в JSON (после исчерпания повторов) отдаются текстом, а не падают при разборе
+    """
+
+    def send(self, request_type, method: str, status: int, body: bytes, codec: str = "json"):
+        async def handler(request):
+            return web.Response(status=status, body=body, content_type="text/html")
+
+        async def main():
+            async with serve({("*", "/api/thing"): handler}, codec=codec) as session:
+                return await request_type(session, method, "/api/thing").async_send()
+        return asyncio.run(main())
+
+    def test_request_html_error(self):
+        for status in (429, 502, 503):
+            with self.subTest(status=status):
+                self.assertEqual(self.send(redforester.Request, "GET", status, b"<html>bad gateway</html>"),
+                                 (status, "<html>bad gateway</html>"))
+
+    def test_action_text_error(self):
+        self.assertEqual(self.send(redforester.Action, "PATCH", 503, b"Service Unavailable"),
+                         (503, "Service Unavailable"))
+
+    def test_json_error_is_decoded(self):
+        status, body = self.send(redforester.Action, "PATCH", 403, b'{"code": "0403", "message": "no access"}')
+        self.assertEqual((status, body), (403, {"code": "0403", "message": "no access"}))
+
+    def test_error_without_code(self):
+        self.assertEqual(self.send(redforester.Request, "GET", 400, b'["unexpected"]'), (400, ["unexpected"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+
+import redforester
+from helpers import ServerThread
+
+
+class SessionLoopTest(unittest.TestCase):
+    """
+    Пул соединений сессии при использовании из разных циклов событий
+    """
+
+    def setUp(self):
+        server_thread = ServerThread(nodes=10)
+        self.server = server_thread.start()
+        self.addCleanup(server_thread.stop)
+
+    def session(self, **options) -> redforester.Session:
+        return redforester.Session("user", "password", config=self.server.config, logs=None, **options)
+
+    def test_abandoned_pool_is_closed(self):
+        session = self.session()
+        redforester.Nodes(session).get_by_id("map-0-node-1")
+        old_client = session._client
+
+        async def use():
+            try:
+                return await redforester.Nodes(session).async_get_by_id("map-0-node-2")
+            finally:
+                await session.async_close()
+
+        self.assertEqual(asyncio.run(use()).id, "map-0-node-2")
+        self.assertFalse(old_client.closed)
+        session.close()
+        self.assertTrue(old_client.closed)
+
+    def test_pool_left_in_closed_loop_fails_loudly(self):
+        session = self.session()
+
+        async def use():
+            return await redforester.Nodes(session).async_get_by_id("map-0-node-1")
+
+        asyncio.run(use())
+        with self.assertRaises(RuntimeError):
+            session.close()
+
+    def test_sync_session_used_from_another_loop(self):
+        session = self.session(sync=True)
+        redforester.Nodes(session).get_by_id("map-0-node-1")
+        old_client = session._client
+
+        async def use():
+            try:
+                return await redforester.Nodes(session).async_get_by_id("map-0-node-2")
+            finally:
+                await session.async_close()
+
+        self.assertEqual(asyncio.run(use()).id, "map-0-node-2")
+        session.close()
+        self.assertTrue(old_client.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+import redforester
+from helpers import ServerThread
+
+
+class SyncUnitOfWorkTest(unittest.TestCase):
+    """
+    В синхронном коде UnitOfWork отправляет изменения по накоплении max_pending объектов
+    """
+
+    def setUp(self):
+        server_thread = ServerThread(nodes=20)
+        self.server = server_thread.start()
+        self.addCleanup(server_thread.stop)
+
+    def check_max_pending(self, sync: bool):
+        with redforester.Session("user", "password", config=self.server.config, logs=None, sync=sync) as session:
+            nodes = [redforester.Nodes(session).get_by_id(f"map-0-node-{index}") for index in range(1, 11)]
+            with redforester.UnitOfWork(session, max_pending=3) as unit:
+                unit.track(*nodes)
+                for node in nodes:
+                    node.hidden = True
+                self.assertEqual(unit.pending, 1)
+                self.assertEqual(self.server.stats.get("POST batch"), 3)
+        self.assertTrue(all(self.server.nodes[node.id]["hidden"] for node in nodes))
+
+    def test_max_pending(self):
+        self.check_max_pending(sync=False)
+
+    def test_max_pending_sync_session(self):
+        self.check_max_pending(sync=True)
+
+
+if __name__ == "__main__":
+    unittest.main()